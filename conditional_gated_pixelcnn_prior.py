@@ -22,9 +22,13 @@ learning_rate = 1e-4
 epochs = 10
 batch_size = 32
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 image_size = 64
 use_noise_images = False
 load_data_to_memory = False
+use_packed_data = False  # Read the images from a packed memory mapped file
+use_token_cache = False  # Encode the data once & train on cached encodings
 
 experiment_name = f"conditional_gated_pixelcnn_v1"
 
@@ -47,6 +51,7 @@ num_classes = vq_vae_num_embeddings
 kernel_size = 3
 use_bits_per_dimension_loss = False
 use_dilation = True
+crop_kernels = True  # Drop the always masked rows & columns of the kernels
 conditioning_info_columns = ["type1", "type2", "shape"]
 sample_batch_size = batch_size
 num_sample_batches = 5
@@ -55,9 +60,11 @@ sample_conditioning_dict = {"type1": 1, "type2": 2, "shape": 1}
 # Data Config
 conditioning_info_file = "data\\Pokemon\\metadata.joblib"
 data_prefix = "data\\Pokemon\\final\\standard"
+packed_data_prefix = f"{data_prefix}_packed"
 output_prefix = f"data\\{experiment_name}"
 vq_vae_model_prefix = f"outputs\\{vq_vae_experiment_name}"
 vq_vae_model_path = os.path.join(vq_vae_model_prefix, "model.pt")
+token_cache_dir = os.path.join(vq_vae_model_prefix, "token_cache")
 
 train_data_folder = os.path.join(data_prefix, "train")
 val_data_folder = os.path.join(data_prefix, "val")
@@ -79,6 +86,22 @@ print(gpu, device)
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
+# Create & Load VQVAE Model
+vq_vae_config = {
+    "num_layers": vq_vae_num_layers,
+    "input_image_dimensions": image_size,
+    "small_conv": vq_vae_small_conv,
+    "embedding_dim": vq_vae_embedding_dim,
+    "num_embeddings": vq_vae_num_embeddings,
+    "commitment_cost": vq_vae_commitment_cost,
+    "use_max_filters": vq_vae_use_max_filters,
+    "max_filters": vq_vae_max_filters,
+}
+vq_vae = vqvae.VQVAE(**vq_vae_config)
+vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
+vq_vae.eval()
+vq_vae.to(device)
+
 ################################################################################
 ################################## Data Setup ##################################
 ################################################################################
@@ -86,7 +109,18 @@ if not os.path.exists(output_dir):
 # Preprocess & Create Data Loaders
 transform = data.image2tensor_resize(image_size)
 
-if load_data_to_memory:
+if use_packed_data:
+    # Packs each split into one memory mapped file the first time
+    train_data = data.load_packed_dataset(
+        train_data_folder, os.path.join(packed_data_prefix, "train"), transform, use_noise_images
+    )
+    val_data = data.load_packed_dataset(
+        val_data_folder, os.path.join(packed_data_prefix, "val"), transform, use_noise_images
+    )
+    test_data = data.load_packed_dataset(
+        test_data_folder, os.path.join(packed_data_prefix, "test"), transform, use_noise_images
+    )
+elif load_data_to_memory:
     # Load Data
     train = data.load_images_from_folder(train_data_folder, use_noise_images)
     val = data.load_images_from_folder(val_data_folder, use_noise_images)
@@ -106,28 +140,50 @@ else:
         test_data_folder, transform, use_noise_images
     )
 
+if use_token_cache:
+    # Encode every image once with the frozen VQ-VAE
+    # The dataloaders then serve the cached encodings instead of images
+    train_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, train_data, token_cache_dir, "train", device
+    )
+    val_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, val_data, token_cache_dir, "val", device
+    )
+    test_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, test_data, token_cache_dir, "test", device
+    )
+else:
+    train_loader_data = train_data
+    val_loader_data = val_data
+    test_loader_data = test_data
+
 train_dataloader = torch.utils.data.DataLoader(
-    train_data,
+    train_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 val_dataloader = torch.utils.data.DataLoader(
-    val_data,
+    val_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 test_dataloader = torch.utils.data.DataLoader(
-    test_data,
+    test_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 # Creating a sample set to visualize the model's training
 sample = data.get_samples_from_data(val_data, 16)
 
@@ -140,21 +196,6 @@ conditioning_classes = label_handler.get_size()
 ##################################### Model ####################################
 ################################################################################
 
-# Create & Load VQVAE Model
-vq_vae = vqvae.VQVAE(
-    num_layers=vq_vae_num_layers,
-    input_image_dimensions=image_size,
-    small_conv=vq_vae_small_conv,
-    embedding_dim=vq_vae_embedding_dim,
-    num_embeddings=vq_vae_num_embeddings,
-    commitment_cost=vq_vae_commitment_cost,
-    use_max_filters=vq_vae_use_max_filters,
-    max_filters=vq_vae_max_filters,
-)
-vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
-vq_vae.eval()
-vq_vae.to(device)
-
 # Create Model
 model = gated_pixelcnn.ConditionalPixelCNN(
     c_in=input_channels,
@@ -163,6 +204,7 @@ model = gated_pixelcnn.ConditionalPixelCNN(
     conditioning_size=conditioning_classes,
     kernel_size=kernel_size,
     use_dilation=use_dilation,
+    crop_kernels=crop_kernels,
 )
 model.to(device)
 print(model)
@@ -195,12 +237,13 @@ for epoch in range(epochs):
         key, batch = batch  # (names), (images)
         batch = batch.to(device)
         conditioning = torch.as_tensor(label_handler(key)).float().to(device)
-        current_batch_size = batch.shape[0]
 
         with torch.no_grad():
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(batch)
-            x = encodings.reshape(current_batch_size, 1, input_dim, input_dim)
+            if use_token_cache:
+                x = batch.long().unsqueeze(1)
+            else:
+                x = vq_vae.encode(batch).long().unsqueeze(1)
 
         # Run our model & get outputs
         y_hat = model(x, conditioning)
@@ -223,12 +266,13 @@ for epoch in range(epochs):
             key, batch = batch  # (names), (images)
             batch = batch.to(device)
             conditioning = torch.as_tensor(label_handler(key)).float().to(device)
-            current_batch_size = batch.shape[0]
 
             with torch.no_grad():
                 # Get Encodings from vq_vae
-                _, _, _, encodings = vq_vae(batch)
-                x = encodings.reshape(current_batch_size, 1, input_dim, input_dim)
+                if use_token_cache:
+                    x = batch.long().unsqueeze(1)
+                else:
+                    x = vq_vae.encode(batch).long().unsqueeze(1)
 
             # Run our model & get outputs
             y_hat = model(x, conditioning)
@@ -250,6 +294,9 @@ for epoch in range(epochs):
         \nTrain Loss = {train_loss}\
         \nVal Loss = {val_loss}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
@@ -281,12 +328,13 @@ with torch.no_grad():
         key, batch = batch  # (names), (images)
         batch = batch.to(device)
         conditioning = torch.as_tensor(label_handler(key)).float().to(device)
-        current_batch_size = batch.shape[0]
 
         with torch.no_grad():
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(batch)
-            x = encodings.reshape(current_batch_size, 1, input_dim, input_dim)
+            if use_token_cache:
+                x = batch.long().unsqueeze(1)
+            else:
+                x = vq_vae.encode(batch).long().unsqueeze(1)
 
         # Run our model & get outputs
         y_hat = model(x, conditioning)
@@ -298,7 +346,6 @@ test_loss = test_loss / len(test_dataloader)
 print(f"Test Loss: {test_loss}")
 
 # Generate samples
-target_shape = (sample_batch_size, input_dim, input_dim, vq_vae_embedding_dim)
 image_shape = (sample_batch_size, input_channels, input_dim, input_dim)
 for i in range(num_sample_batches):
     # Pick some random conditioning info
@@ -308,8 +355,7 @@ for i in range(num_sample_batches):
         # Sample from model
         sample = model.sample(image_shape, device, conditioning_info)
         # Feed into VQ-VAE
-        sample = sample.flatten(start_dim=1).view(-1, 1)
-        sample = vq_vae.quantize_and_decode(sample, target_shape, device)
+        sample = vq_vae.decode(sample.squeeze(1))
     # Convert to image
     sample = sample.permute(0, 2, 3, 1).detach().cpu().numpy()
     # Save
@@ -23,6 +23,8 @@ learning_rate = 1e-4
 epochs = 2
 batch_size = 64
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 
 experiment_name = f"convolutional_vae_v10"
 
@@ -107,6 +109,11 @@ test_dataloader = torch.utils.data.DataLoader(
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 # Creating a sample set to visualize the model's training
 sample = data.get_samples_from_data(val_data, 16)
 
@@ -282,6 +289,9 @@ for epoch in range(epochs):
         \nVal Reconstruction Loss = {val_recon_loss}\
         \nVal KL Divergence = {val_kl_d}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
@@ -23,12 +23,16 @@ learning_rate = 1e-4
 epochs = 2
 batch_size = 64
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 
 experiment_name = f"fusion_dual_input_autoencoder_v1"
 
 num_layers = 4
 max_filters = 512
 image_size = 64
+# Bytes of transformed base images shared by the dataloader workers (0 = off)
+image_cache_size = 0  # E.g. 256 * 1024 * 1024
 latent_dim = 2048
 use_noise_images = True
 small_conv = True  # To use the 1x1 convolution layer
@@ -88,6 +92,13 @@ if not os.path.exists(output_dir):
 
 # Preprocess & Create Data Loaders
 transform = data.image2tensor_resize(image_size)
+# Each base sprite is decoded once instead of once per fusion
+# Only shared memory when there are worker processes to share it with
+image_cache = data.SharedImageCache(
+    image_cache_size,
+    (3, image_size, image_size),
+    shared=num_dataloader_workers > 0,
+)
 
 train_data = data.FusionDatasetV2(
     train_data_folder,
@@ -95,12 +106,23 @@ train_data = data.FusionDatasetV2(
     data_prefix,
     transform,
     use_noise_images,
+    image_cache=image_cache,
 )
 val_data = data.FusionDatasetV2(
-    val_data_folder, fusion_val_data_folder, data_prefix, transform, use_noise_images
+    val_data_folder,
+    fusion_val_data_folder,
+    data_prefix,
+    transform,
+    use_noise_images,
+    image_cache=image_cache,
 )
 test_data = data.FusionDatasetV2(
-    test_data_folder, fusion_test_data_folder, data_prefix, transform, use_noise_images
+    test_data_folder,
+    fusion_test_data_folder,
+    data_prefix,
+    transform,
+    use_noise_images,
+    image_cache=image_cache,
 )
 
 train_dataloader = torch.utils.data.DataLoader(
@@ -125,6 +147,11 @@ test_dataloader = torch.utils.data.DataLoader(
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 # Creating a sample set to visualize the model's training
 sample = data.get_samples_from_FusionDatasetV2(val_data, 16, "standard")
 fusion_sample = data.get_samples_from_FusionDatasetV2(val_data, 4, "fusion")
@@ -291,10 +318,15 @@ for epoch in range(epochs):
         \nTrain Loss = {train_loss}\
         \nVal Loss = {val_loss}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
 ################################################################################
+print(f"Image cache: {image_cache.get_stats()}")
+
 # Generate Loss Graph
 graphics.draw_loss(all_train_loss, all_val_loss, loss_output_path, mode="autoencoder")
 
@@ -23,8 +23,12 @@ learning_rate = 1e-4
 epochs = 10
 batch_size = 64
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 
 image_size = 64
+# Bytes of transformed base images shared by the dataloader workers (0 = off)
+image_cache_size = 0  # E.g. 256 * 1024 * 1024
 use_noise_images = True
 only_fusions = False
 
@@ -93,6 +97,13 @@ if not os.path.exists(output_dir):
 
 # Preprocess & Create Data Loaders
 transform = data.image2tensor_resize(image_size)
+# Each base sprite is decoded once instead of once per fusion
+# Only shared memory when there are worker processes to share it with
+image_cache = data.SharedImageCache(
+    image_cache_size,
+    (3, image_size, image_size),
+    shared=num_dataloader_workers > 0,
+)
 
 train_data = data.FusionDatasetV2(
     train_data_folder,
@@ -101,6 +112,7 @@ train_data = data.FusionDatasetV2(
     transform,
     use_noise_images,
     only_fusions=only_fusions,
+    image_cache=image_cache,
 )
 val_data = data.FusionDatasetV2(
     val_data_folder,
@@ -109,6 +121,7 @@ val_data = data.FusionDatasetV2(
     transform,
     use_noise_images,
     only_fusions=only_fusions,
+    image_cache=image_cache,
 )
 test_data = data.FusionDatasetV2(
     test_data_folder,
@@ -117,6 +130,7 @@ test_data = data.FusionDatasetV2(
     transform,
     use_noise_images,
     only_fusions=only_fusions,
+    image_cache=image_cache,
 )
 
 train_dataloader = torch.utils.data.DataLoader(
@@ -141,6 +155,11 @@ test_dataloader = torch.utils.data.DataLoader(
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 ################################################################################
 ##################################### Model ####################################
 ################################################################################
@@ -326,10 +345,15 @@ for epoch in range(epochs):
         \nTrain Loss = {train_loss}\
         \nVal Loss = {val_loss}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
 ################################################################################
+print(f"Image cache: {image_cache.get_stats()}")
+
 # Generate Loss Graph
 graphics.draw_loss(all_train_loss, all_val_loss, loss_output_path, mode="autoencoder")
 
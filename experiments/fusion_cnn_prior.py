@@ -23,6 +23,8 @@ learning_rate = 1e-4
 epochs = 5
 batch_size = 64
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 
 only_fusions = False
 
@@ -42,6 +44,8 @@ vq_vae_commitment_cost = 0.25
 vq_vae_small_conv = True  # To use the 1x1 convolution layer
 
 image_size = 64
+# Bytes of transformed base images shared by the dataloader workers (0 = off)
+image_cache_size = 0  # E.g. 256 * 1024 * 1024
 use_noise_images = True
 
 # EIEO = Encoding In Encoding Out
@@ -111,6 +115,13 @@ if not os.path.exists(output_dir):
 
 # Preprocess & Create Data Loaders
 transform = data.image2tensor_resize(image_size)
+# Each base sprite is decoded once instead of once per fusion
+# Only shared memory when there are worker processes to share it with
+image_cache = data.SharedImageCache(
+    image_cache_size,
+    (3, image_size, image_size),
+    shared=num_dataloader_workers > 0,
+)
 
 train_data = data.FusionDatasetV2(
     train_data_folder,
@@ -119,6 +130,7 @@ train_data = data.FusionDatasetV2(
     transform,
     use_noise_images,
     only_fusions=only_fusions,
+    image_cache=image_cache,
 )
 val_data = data.FusionDatasetV2(
     val_data_folder,
@@ -127,6 +139,7 @@ val_data = data.FusionDatasetV2(
     transform,
     use_noise_images,
     only_fusions=only_fusions,
+    image_cache=image_cache,
 )
 test_data = data.FusionDatasetV2(
     test_data_folder,
@@ -135,6 +148,7 @@ test_data = data.FusionDatasetV2(
     transform,
     use_noise_images,
     only_fusions=only_fusions,
+    image_cache=image_cache,
 )
 
 train_dataloader = torch.utils.data.DataLoader(
@@ -159,6 +173,11 @@ test_dataloader = torch.utils.data.DataLoader(
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 ################################################################################
 ##################################### Model ####################################
 ################################################################################
@@ -372,10 +391,15 @@ for epoch in range(epochs):
         \nTrain Loss = {train_loss}\
         \nVal Loss = {val_loss}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
 ################################################################################
+print(f"Image cache: {image_cache.get_stats()}")
+
 # Generate Loss Graph
 graphics.draw_loss(all_train_loss, all_val_loss, loss_output_path, mode="autoencoder")
 
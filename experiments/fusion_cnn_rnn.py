@@ -27,6 +27,7 @@ num_dataloader_workers = 0
 
 image_size = 64
 use_noise_images = True
+use_token_cache = False  # Encode the fusion targets once & reuse them
 
 experiment_name = f"cnn_rnn_v1"
 
@@ -58,6 +59,7 @@ output_prefix = f"data\\{experiment_name}"
 vq_vae_model_prefix = f"outputs\\{vq_vae_experiment_name}"
 
 vq_vae_model_path = os.path.join(vq_vae_model_prefix, "model.pt")
+token_cache_dir = os.path.join(vq_vae_model_prefix, "token_cache")
 
 train_data_folder = os.path.join(data_prefix, "train")
 val_data_folder = os.path.join(data_prefix, "val")
@@ -132,20 +134,38 @@ test_dataloader = torch.utils.data.DataLoader(
 ################################################################################
 
 # Create & Load VQVAE Model
-vq_vae = vqvae.VQVAE(
-    num_layers=vq_vae_num_layers,
-    input_image_dimensions=image_size,
-    small_conv=vq_vae_small_conv,
-    embedding_dim=vq_vae_embedding_dim,
-    num_embeddings=vq_vae_num_embeddings,
-    commitment_cost=vq_vae_commitment_cost,
-    use_max_filters=vq_vae_use_max_filters,
-    max_filters=vq_vae_max_filters,
-)
+vq_vae_config = {
+    "num_layers": vq_vae_num_layers,
+    "input_image_dimensions": image_size,
+    "small_conv": vq_vae_small_conv,
+    "embedding_dim": vq_vae_embedding_dim,
+    "num_embeddings": vq_vae_num_embeddings,
+    "commitment_cost": vq_vae_commitment_cost,
+    "use_max_filters": vq_vae_use_max_filters,
+    "max_filters": vq_vae_max_filters,
+}
+vq_vae = vqvae.VQVAE(**vq_vae_config)
 vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
 vq_vae.eval()
 vq_vae.to(device)
 
+if use_token_cache:
+    # Encode every fusion target once with the frozen VQ-VAE
+    # Base images are their own targets so they get cached as well
+    # Batches then look up their targets by fusion filename
+    token_caches = {}
+    for split, base_folder, fusion_folder in [
+        ("train", train_data_folder, fusion_train_data_folder),
+        ("val", val_data_folder, fusion_val_data_folder),
+        ("test", test_data_folder, fusion_test_data_folder),
+    ]:
+        targets = data.CombinedDataset(
+            base_folder, fusion_folder, transform, use_noise_images
+        )
+        token_caches[split] = data.load_token_cache(
+            vq_vae, vq_vae_config, targets, token_cache_dir, split, device
+        )
+
 # Create Model
 model = cnn_rnn.CNN_RNN(
     num_classes=prior_num_classes,
@@ -167,11 +187,11 @@ class_weights = torch.full(
     (prior_num_classes,), fill_value=normal_weight, device=device, dtype=torch.float32
 )
 with torch.no_grad():
-    _, _, _, encodings = vq_vae(transform(white).unsqueeze(0).to(device))
-    white = encodings.flatten()[0].detach()
+    white = vq_vae.encode(transform(white).unsqueeze(0).to(device))
+    white = white.flatten()[0].long()
     class_weights[white] = background_weight
-    _, _, _, encodings = vq_vae(transform(black).unsqueeze(0).to(device))
-    black = encodings.flatten()[0].detach()
+    black = vq_vae.encode(transform(black).unsqueeze(0).to(device))
+    black = black.flatten()[0].long()
     class_weights[black] = background_weight
 
 optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
@@ -198,7 +218,7 @@ for epoch in range(epochs):
         batch_loss = 0
 
         # Move batch to device
-        _, (base, fusee, fusion) = batch  # (names), (images)
+        (_, _, fusion_filenames), (base, fusee, fusion) = batch  # (names), (images)
         base = base.to(device)
         fusee = fusee.to(device)
         fusion = fusion.to(device)
@@ -206,12 +226,11 @@ for epoch in range(epochs):
 
         with torch.no_grad():
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(fusion)
-            # Reshape encodings
-            y = encodings.reshape(
-                current_batch_size,
-                vq_vae_encoded_image_size * vq_vae_encoded_image_size,
-            )
+            if use_token_cache:
+                y = token_caches["train"].get_codes(fusion_filenames)
+                y = y.to(device).long().flatten(start_dim=1)
+            else:
+                y = vq_vae.encode(fusion).long().flatten(start_dim=1)
 
         # Get Encoder Outputs
         decoder_input = model.encode(torch.cat([base, fusee], dim=1))
@@ -249,19 +268,18 @@ for epoch in range(epochs):
         for iteration, batch in enumerate(tqdm(val_dataloader)):
             batch_loss = 0
             # Move batch to device
-            _, (base, fusee, fusion) = batch  # (names), (images)
+            (_, _, fusion_filenames), (base, fusee, fusion) = batch
             base = base.to(device)
             fusee = fusee.to(device)
             fusion = fusion.to(device)
             current_batch_size = base.shape[0]
 
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(fusion)
-            # Reshape encodings
-            y = encodings.reshape(
-                current_batch_size,
-                vq_vae_encoded_image_size * vq_vae_encoded_image_size,
-            )
+            if use_token_cache:
+                y = token_caches["val"].get_codes(fusion_filenames)
+                y = y.to(device).long().flatten(start_dim=1)
+            else:
+                y = vq_vae.encode(fusion).long().flatten(start_dim=1)
 
             # Get Encoder Outputs
             decoder_input = model.encode(torch.cat([base, fusee], dim=1))
@@ -331,12 +349,11 @@ with torch.no_grad():
         current_batch_size = base.shape[0]
 
         # Get Encodings from vq_vae
-        _, _, _, encodings = vq_vae(fusion)
-        # Reshape encodings
-        y = encodings.reshape(
-            current_batch_size,
-            vq_vae_encoded_image_size * vq_vae_encoded_image_size,
-        )
+        if use_token_cache:
+            y = token_caches["test"].get_codes(fusion_filenames)
+            y = y.to(device).long().flatten(start_dim=1)
+        else:
+            y = vq_vae.encode(fusion).long().flatten(start_dim=1)
         y_hat = torch.zeros_like(y)
 
         # Get Encoder Outputs
@@ -355,14 +372,10 @@ with torch.no_grad():
             y_hat[:, i] = decoder_output.squeeze(1).argmax(dim=1).detach().cpu()
 
         # Make y_hat an image
-        target_shape = (
-            current_batch_size,
-            vq_vae_encoded_image_size,
-            vq_vae_encoded_image_size,
-            vq_vae_embedding_dim,
+        y_hat = y_hat.view(
+            current_batch_size, vq_vae_encoded_image_size, vq_vae_encoded_image_size
         )
-        y_hat = y_hat.view(-1, 1)
-        y_hat = vq_vae.quantize_and_decode(y_hat, target_shape, device)
+        y_hat = vq_vae.decode(y_hat)
 
         # Create mask
         mask = (base == fusee).flatten(start_dim=1).all(dim=1)
@@ -23,9 +23,13 @@ learning_rate = 1e-4
 epochs = 1
 batch_size = 32
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 image_size = 64
 use_noise_images = True
 load_data_to_memory = False
+use_packed_data = False  # Read the images from a packed memory mapped file
+use_token_cache = False  # Encode the data once & train on cached encodings
 
 experiment_name = f"gated_pixelcnn_v1"
 
@@ -50,12 +54,21 @@ sample_batch_size = batch_size
 num_sample_batches = 5
 use_bits_per_dimension_loss = False
 use_dilation = True
+crop_kernels = True  # Drop the always masked rows & columns of the kernels
+# Only model the tokens inside every sprite's foreground box
+# (needs use_packed_data & use_token_cache): background tokens are left out
+# of the loss & filled in before sampling
+use_foreground_boxes = False
+foreground_box_padding = 1  # Extra tokens around the boxes (encoder receptive field)
+use_box_batching = True  # Batch sprites with similar boxes to crop the empty rows
 
 # Data Config
 data_prefix = "data\\pokemon\\final\\standard"
+packed_data_prefix = f"{data_prefix}_packed"
 output_prefix = f"data\\{experiment_name}"
 vq_vae_model_prefix = f"outputs\\{vq_vae_experiment_name}"
 vq_vae_model_path = os.path.join(vq_vae_model_prefix, "model.pt")
+token_cache_dir = os.path.join(vq_vae_model_prefix, "token_cache")
 
 train_data_folder = os.path.join(data_prefix, "train")
 val_data_folder = os.path.join(data_prefix, "val")
@@ -68,6 +81,10 @@ model_output_path = os.path.join(output_prefix, "model.pt")
 ##################################### Setup ####################################
 ################################################################################
 
+# The boxes come from the packed data & are paired with the cached token grids
+if use_foreground_boxes and not (use_packed_data and use_token_cache):
+    raise ValueError("use_foreground_boxes needs use_packed_data & use_token_cache")
+
 # Setup Device
 gpu = torch.cuda.is_available()
 device = torch.device("cuda" if gpu else "cpu")
@@ -77,6 +94,22 @@ print(gpu, device)
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
+# Create & Load VQVAE Model
+vq_vae_config = {
+    "num_layers": vq_vae_num_layers,
+    "input_image_dimensions": image_size,
+    "small_conv": vq_vae_small_conv,
+    "embedding_dim": vq_vae_embedding_dim,
+    "num_embeddings": vq_vae_num_embeddings,
+    "commitment_cost": vq_vae_commitment_cost,
+    "use_max_filters": vq_vae_use_max_filters,
+    "max_filters": vq_vae_max_filters,
+}
+vq_vae = vqvae.VQVAE(**vq_vae_config)
+vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
+vq_vae.eval()
+vq_vae.to(device)
+
 ################################################################################
 ################################## Data Setup ##################################
 ################################################################################
@@ -84,7 +117,18 @@ if not os.path.exists(output_dir):
 # Preprocess & Create Data Loaders
 transform = data.image2tensor_resize(image_size)
 
-if load_data_to_memory:
+if use_packed_data:
+    # Packs each split into one memory mapped file the first time
+    train_data = data.load_packed_dataset(
+        train_data_folder, os.path.join(packed_data_prefix, "train"), transform, use_noise_images
+    )
+    val_data = data.load_packed_dataset(
+        val_data_folder, os.path.join(packed_data_prefix, "val"), transform, use_noise_images
+    )
+    test_data = data.load_packed_dataset(
+        test_data_folder, os.path.join(packed_data_prefix, "test"), transform, use_noise_images
+    )
+elif load_data_to_memory:
     # Load Data
     train = data.load_images_from_folder(train_data_folder, use_noise_images)
     val = data.load_images_from_folder(val_data_folder, use_noise_images)
@@ -98,28 +142,64 @@ else:
     val_data = data.CustomDatasetNoMemory(val_data_folder, transform, use_noise_images)
     test_data = data.CustomDatasetNoMemory(test_data_folder, transform, use_noise_images)
 
+if use_token_cache:
+    # Encode every image once with the frozen VQ-VAE
+    # The dataloaders then serve the cached encodings instead of images
+    train_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, train_data, token_cache_dir, "train", device
+    )
+    val_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, val_data, token_cache_dir, "val", device
+    )
+    test_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, test_data, token_cache_dir, "test", device
+    )
+else:
+    train_loader_data = train_data
+    val_loader_data = val_data
+    test_loader_data = test_data
+
+if use_foreground_boxes:
+    # Foreground boxes on the encoding grid, by filename
+    train_boxes = train_data.get_boxes(input_dim, foreground_box_padding)
+    foreground_boxes = dict(zip(train_data.filenames, train_boxes))
+    for split_data in [val_data, test_data]:
+        split_boxes = split_data.get_boxes(input_dim, foreground_box_padding)
+        foreground_boxes.update(zip(split_data.filenames, split_boxes))
+
+if use_foreground_boxes and use_box_batching:
+    train_batching = {
+        "batch_sampler": data.BoundingBoxBatchSampler(train_boxes, batch_size)
+    }
+else:
+    train_batching = {"batch_size": batch_size, "shuffle": True}
+
 train_dataloader = torch.utils.data.DataLoader(
-    train_data,
-    batch_size=batch_size,
-    shuffle=True,
+    train_loader_data,
+    **train_batching,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 val_dataloader = torch.utils.data.DataLoader(
-    val_data,
+    val_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 test_dataloader = torch.utils.data.DataLoader(
-    test_data,
+    test_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 # Creating a sample set to visualize the model's training
 sample = data.get_samples_from_data(val_data, 16)
 
@@ -127,21 +207,6 @@ sample = data.get_samples_from_data(val_data, 16)
 ##################################### Model ####################################
 ################################################################################
 
-# Create & Load VQVAE Model
-vq_vae = vqvae.VQVAE(
-    num_layers=vq_vae_num_layers,
-    input_image_dimensions=image_size,
-    small_conv=vq_vae_small_conv,
-    embedding_dim=vq_vae_embedding_dim,
-    num_embeddings=vq_vae_num_embeddings,
-    commitment_cost=vq_vae_commitment_cost,
-    use_max_filters=vq_vae_use_max_filters,
-    max_filters=vq_vae_max_filters,
-)
-vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
-vq_vae.eval()
-vq_vae.to(device)
-
 # Create Model
 model = gated_pixelcnn.PixelCNN(
     c_in=input_channels,
@@ -149,6 +214,7 @@ model = gated_pixelcnn.PixelCNN(
     num_classes=num_classes,
     kernel_size=kernel_size,
     use_dilation=use_dilation,
+    crop_kernels=crop_kernels,
 )
 model.to(device)
 print(model)
@@ -159,6 +225,18 @@ if use_bits_per_dimension_loss:
 else:
     criterion = nn.CrossEntropyLoss()
 
+
+def compute_loss(filenames, x):
+    if not use_foreground_boxes:
+        return criterion(model(x), x)
+    # Rows below every box of the batch don't change the predictions above
+    # them (masked convolutions), so they're cropped
+    boxes = torch.as_tensor(np.stack([foreground_boxes[f] for f in filenames]))
+    x = x[:, :, : max(int(boxes[:, 2].max()), 1)]
+    mask = data.get_box_mask(boxes, x.shape[2], x.shape[3]).unsqueeze(1).to(device)
+    return loss.masked_crossentropy_loss(model(x), x, mask)
+
+
 ################################################################################
 ################################### Training ###################################
 ################################################################################
@@ -178,18 +256,18 @@ for epoch in range(epochs):
         optimizer.zero_grad()
 
         # Move batch to device
-        _, batch = batch  # (names), (images)
+        filenames, batch = batch  # (names), (images)
         batch = batch.to(device)
-        current_batch_size = batch.shape[0]
 
         with torch.no_grad():
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(batch)
-            x = encodings.reshape(current_batch_size, 1, input_dim, input_dim)
+            if use_token_cache:
+                x = batch.long().unsqueeze(1)
+            else:
+                x = vq_vae.encode(batch).long().unsqueeze(1)
 
-        # Run our model & get outputs
-        y_hat = model.forward(x)
-        batch_loss = criterion(y_hat, x)
+        # Run our model & get the loss
+        batch_loss = compute_loss(filenames, x)
 
         # Backprop
         batch_loss.backward()
@@ -205,18 +283,18 @@ for epoch in range(epochs):
     with torch.no_grad():
         for iteration, batch in enumerate(tqdm(val_dataloader)):
             # Move batch to device
-            _, batch = batch  # (names), (images)
+            filenames, batch = batch  # (names), (images)
             batch = batch.to(device)
-            current_batch_size = batch.shape[0]
 
             with torch.no_grad():
                 # Get Encodings from vq_vae
-                _, _, _, encodings = vq_vae(batch)
-                x = encodings.reshape(current_batch_size, 1, input_dim, input_dim)
+                if use_token_cache:
+                    x = batch.long().unsqueeze(1)
+                else:
+                    x = vq_vae.encode(batch).long().unsqueeze(1)
 
-            # Run our model & get outputs
-            y_hat = model.forward(x)
-            batch_loss = criterion(y_hat, x)
+            # Run our model & get the loss
+            batch_loss = compute_loss(filenames, x)
 
             # Add the batch's loss to the total loss for the epoch
             val_loss += batch_loss.item()
@@ -234,6 +312,9 @@ for epoch in range(epochs):
         \nTrain Loss = {train_loss}\
         \nVal Loss = {val_loss}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
@@ -261,18 +342,18 @@ test_loss = 0
 with torch.no_grad():
     for iteration, batch in enumerate(tqdm(test_dataloader)):
         # Move batch to device
-        _, batch = batch  # (names), (images)
+        filenames, batch = batch  # (names), (images)
         batch = batch.to(device)
-        current_batch_size = batch.shape[0]
 
         with torch.no_grad():
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(batch)
-            x = encodings.reshape(current_batch_size, 1, input_dim, input_dim)
+            if use_token_cache:
+                x = batch.long().unsqueeze(1)
+            else:
+                x = vq_vae.encode(batch).long().unsqueeze(1)
 
-        # Run our model & get outputs
-        y_hat = model.forward(x)
-        batch_loss = criterion(y_hat, x)
+        # Run our model & get the loss
+        batch_loss = compute_loss(filenames, x)
 
         # Add the batch's loss to the total loss for the epoch
         test_loss += batch_loss.item()
@@ -280,14 +361,21 @@ test_loss = test_loss / len(test_dataloader)
 print(f"Test Loss: {test_loss}")
 
 # Generate samples
-target_shape = (sample_batch_size, input_dim, input_dim, vq_vae_embedding_dim)
 image_shape = (sample_batch_size, input_channels, input_dim, input_dim)
 for i in range(num_sample_batches):
+    start_image = None
+    if use_foreground_boxes:
+        # Reuse the boxes & background tokens (top left) of random training
+        # sprites, only the tokens inside the boxes get sampled
+        picks = np.random.choice(len(train_loader_data), sample_batch_size)
+        background = torch.stack([train_loader_data[x][1][0, 0] for x in picks])
+        mask = data.get_box_mask(train_boxes[picks], input_dim, input_dim)
+        start_image = torch.where(mask, -1, background.long()[:, None, None])
+        start_image = start_image.unsqueeze(1).to(device)
     # Sample from model
-    sample = model.sample(image_shape, device)
+    sample = model.sample(image_shape, device, start_image)
     # Feed into VQ-VAE
-    sample = sample.flatten(start_dim=1).view(-1, 1)
-    sample = vq_vae.quantize_and_decode(sample, target_shape, device)
+    sample = vq_vae.decode(sample.squeeze(1))
     # Convert to image
     sample = sample.permute(0, 2, 3, 1).detach().cpu().numpy()
     # Save
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import numpy as np
 
+from models import utils
+
 
 class ConvolutionalAE(nn.Module):
     def __init__(
@@ -148,6 +150,13 @@ class ConvolutionalAE(nn.Module):
             reconstructed = self.decoder(hidden_state)
             return reconstructed
 
+    def optimize_for_inference(self):
+        """
+        Frozen copy with the encoder/decoder batch norms folded into the convs.
+        Only for sampling, the copy can't be trained.
+        """
+        return utils.optimize_for_inference(self)
+
 
 class FusionAE(nn.Module):
     def __init__(
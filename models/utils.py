@@ -1,3 +1,5 @@
+import copy
+
 import torch
 import torch.nn as nn
 import numpy as np
@@ -35,4 +37,75 @@ def weights_init(m, mean=0.0, std=0.02):
         nn.init.normal_(m.weight.data, mean, std)
     elif classname.find('BatchNorm') != -1:
         nn.init.normal_(m.weight.data, 1.0, std)
-        nn.init.constant_(m.bias.data, 0)
\ No newline at end of file
+        nn.init.constant_(m.bias.data, 0)
+
+def fold_batch_norm(conv, batch_norm):
+    """
+    Returns a copy of conv with the (eval mode) batch norm statistics folded
+    into its weights & bias, so conv -> batch_norm becomes a single conv.
+    """
+    std = torch.sqrt(batch_norm.running_var + batch_norm.eps)
+    scale = batch_norm.weight / std if batch_norm.affine else 1 / std
+    shift = batch_norm.bias if batch_norm.affine else torch.zeros_like(std)
+    if conv.bias is not None:
+        bias = conv.bias
+    else:
+        bias = torch.zeros_like(batch_norm.running_mean)
+
+    fused = copy.deepcopy(conv)
+    if isinstance(conv, nn.ConvTranspose2d):
+        # Weights are (in_channels, out_channels // groups, kH, kW)
+        weight = conv.weight.view(conv.groups, -1, *conv.weight.shape[1:])
+        weight = weight * scale.view(conv.groups, 1, -1, 1, 1)
+        weight = weight.view_as(conv.weight)
+    else:
+        # Weights are (out_channels, in_channels // groups, kH, kW)
+        weight = conv.weight * scale.view(-1, 1, 1, 1)
+    fused.weight = nn.Parameter(weight.detach().clone())
+    fused.bias = nn.Parameter(((bias - batch_norm.running_mean) * scale + shift).detach())
+    return fused
+
+
+def fold_sequential(sequential):
+    """
+    Folds every Conv2d/ConvTranspose2d -> BatchNorm2d pair of an nn.Sequential
+    and switches the ReLUs to in-place, which is safe once nothing else reads
+    the conv outputs. Activations stay separate layers, so decoder[-1] is
+    still the output activation (used by return_logits).
+    """
+    layers = list(sequential)
+    folded_layers = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        next_layer = layers[i + 1] if i + 1 < len(layers) else None
+        if (
+            isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d))
+            and isinstance(next_layer, nn.BatchNorm2d)
+            and next_layer.track_running_stats
+        ):
+            folded_layers.append(fold_batch_norm(layer, next_layer))
+            i += 2
+            continue
+        if isinstance(layer, nn.ReLU):
+            layer = nn.ReLU(inplace=True)
+        folded_layers.append(layer)
+        i += 1
+    return nn.Sequential(*folded_layers)
+
+
+def optimize_for_inference(model):
+    """
+    Returns a frozen, eval mode copy of model with the batch norms of its
+    encoder/decoder folded into the preceding convolutions.
+    The outputs match model.eval() up to floating point error.
+    The original model is left untouched (it can still be trained).
+    """
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        for name in ["encoder", "decoder"]:
+            sequential = getattr(model, name, None)
+            if isinstance(sequential, nn.Sequential):
+                setattr(model, name, fold_sequential(sequential))
+    model.requires_grad_(False)
+    return model.eval()
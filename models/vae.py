@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import numpy as np
 
+from models import utils
+
 # Ref: https://github.com/sksq96/pytorch-vae/blob/master/vae-cnn.ipynb
 class ConvolutionalVAE(nn.Module):
     def __init__(
@@ -160,6 +162,13 @@ class ConvolutionalVAE(nn.Module):
         log_var = self.fc_log_var(hidden_state)
         return mu, log_var
 
+    def optimize_for_inference(self):
+        """
+        Frozen copy with the encoder/decoder batch norms folded into the convs.
+        Only for sampling, the copy can't be trained.
+        """
+        return utils.optimize_for_inference(self)
+
 
 class FusionVAE(nn.Module):
     def __init__(
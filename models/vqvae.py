@@ -2,10 +2,389 @@ import torch
 import torch.nn as nn
 import numpy as np
 
+from models import utils
+
+# calculate_distances holds about this many (rows, num_embeddings) matrices at
+# its peak (the x^2 + e^2 broadcast, the matmul & its -2 scaled copy, the result)
+distance_temporaries = 3
+
+
+def calculate_distances(flat_input, embeddings):
+    # Euclidean Distance = Sqrt(Sum(Square(Differences)))
+    # We ignore sqrt because we're taking the nearest neighbor
+    # Which doesn't change when we take sqrt
+    # Since we're working with multi-dimensional matrices
+    # We can get rid of the sum as this is a vectorized operation
+    # So we compute Square(Differences)
+    # I.E. (A - B)^2 = A^2 + B^2 - 2AB
+    return (
+        torch.sum(flat_input ** 2, dim=1, keepdim=True)
+        + torch.sum(embeddings ** 2, dim=1)
+        - 2 * torch.matmul(flat_input, embeddings.t())
+    )
+
+
+def kmeans(x, num_clusters, num_iterations=10, seed=0):
+    """
+    Plain Lloyd's k-means used to build the approximate search indices.
+    Centroids are initialised from a seeded random subset of x.
+    Empty clusters keep their previous centroid.
+    Returns centroids (num_clusters, D) and assignments (N,).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_clusters = min(num_clusters, x.shape[0])
+    init = torch.randperm(x.shape[0], generator=generator)[:num_clusters]
+    centroids = x[init.to(x.device)].clone()
+    for _ in range(num_iterations):
+        assignments = torch.argmin(calculate_distances(x, centroids), dim=1)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty].unsqueeze(1).to(
+            x.dtype
+        )
+    assignments = torch.argmin(calculate_distances(x, centroids), dim=1)
+    return centroids, assignments
+
+
+class CodebookSearch:
+    """
+    Base class for the nearest-codebook search used by VectorQuantizerEMA.
+    Subclasses implement build (index construction from a codebook) and
+    search (returns one codebook index per input row).
+    The index is rebuilt lazily: only when the codebook has drifted from the
+    snapshot it was built on by more than rebuild_threshold (relative norm).
+    Final distances are always computed against the current codebook,
+    so a stale index only affects which candidates get considered.
+    memory_budget (bytes) bounds the distance computations: the tiles are
+    sized so the distance matrix & its temporaries (distance_temporaries
+    matrices) fit in it. It's an estimate of the peak, not a hard cap.
+    """
+
+    def __init__(self, rebuild_threshold=0.05, memory_budget=None):
+        self.rebuild_threshold = rebuild_threshold
+        self.memory_budget = memory_budget
+        self.num_builds = 0
+        self._built_codebook = None
+
+    def needs_rebuild(self, codebook):
+        built = self._built_codebook
+        if (
+            built is None
+            or built.shape != codebook.shape
+            or built.device != codebook.device
+        ):
+            return True
+        drift = torch.norm(codebook - built) / torch.norm(built).clamp_min(1e-12)
+        return drift.item() > self.rebuild_threshold
+
+    def __call__(self, flat_input, codebook):
+        codebook = codebook.detach()
+        if self.needs_rebuild(codebook):
+            self.build(codebook)
+            self._built_codebook = codebook.clone()
+            self.num_builds += 1
+        return self.search(flat_input.detach(), codebook)
+
+    def build(self, codebook):
+        pass
+
+    def search(self, flat_input, codebook):
+        raise NotImplementedError
+
+    def row_chunk_size(self, row_elements, element_size):
+        # Number of input rows whose distance rows (& temporaries) fit in the
+        # memory budget
+        if self.memory_budget is None:
+            return None
+        row_bytes = distance_temporaries * row_elements * element_size
+        return max(1, self.memory_budget // row_bytes)
+
+    def recall(self, flat_input, codebook):
+        """
+        Fraction of inputs for which this backend returns the same
+        codebook index as an exact search.
+        """
+        exact = ExactCodebookSearch(memory_budget=self.memory_budget)
+        exact_indices = exact(flat_input, codebook)
+        indices = self(flat_input, codebook)
+        return (indices == exact_indices).float().mean().item()
+
+
+class ExactCodebookSearch(CodebookSearch):
+    """
+    Brute force search over the whole codebook.
+    Without a memory budget the full (N, num_embeddings) distance matrix
+    is computed at once. With a budget (in bytes) we tile over the inputs
+    and the codebook, keeping a running min & argmin for each row.
+    The tiles count the temporaries of calculate_distances, so the peak is
+    about the budget rather than a multiple of it.
+    Ties resolve to the lowest index, same as a single argmin.
+    """
+
+    def needs_rebuild(self, codebook):
+        # Nothing to build
+        return False
+
+    def search(self, flat_input, codebook):
+        num_inputs = flat_input.shape[0]
+        num_embeddings = codebook.shape[0]
+        element_size = flat_input.element_size()
+        # Elements of one distance matrix that fit with its temporaries
+        if self.memory_budget is not None:
+            max_elements = self.memory_budget // (distance_temporaries * element_size)
+            max_elements = max(1, max_elements)
+        if self.memory_budget is None or num_inputs * num_embeddings <= max_elements:
+            distances = calculate_distances(flat_input, codebook)
+            return torch.argmin(distances, dim=1)
+
+        col_chunk = min(num_embeddings, max_elements)
+        row_chunk = max(1, max_elements // col_chunk)
+        encoding_indices = torch.empty(
+            num_inputs, dtype=torch.long, device=flat_input.device
+        )
+        for row_start in range(0, num_inputs, row_chunk):
+            rows = flat_input[row_start : row_start + row_chunk]
+            best_distances = None
+            best_indices = None
+            for col_start in range(0, num_embeddings, col_chunk):
+                cols = codebook[col_start : col_start + col_chunk]
+                distances = calculate_distances(rows, cols)
+                chunk_indices = torch.argmin(distances, dim=1, keepdim=True)
+                chunk_distances = distances.gather(1, chunk_indices).squeeze(1)
+                chunk_indices = chunk_indices.squeeze(1) + col_start
+                if best_distances is None:
+                    best_distances, best_indices = chunk_distances, chunk_indices
+                else:
+                    # Strictly smaller so earlier indices win ties
+                    closer = chunk_distances < best_distances
+                    best_distances = torch.where(
+                        closer, chunk_distances, best_distances
+                    )
+                    best_indices = torch.where(closer, chunk_indices, best_indices)
+            encoding_indices[row_start : row_start + row_chunk] = best_indices
+        return encoding_indices
+
+
+class IVFCodebookSearch(CodebookSearch):
+    """
+    Coarse-to-fine (inverted file) search.
+    The codebook is clustered into num_lists coarse centroids with k-means.
+    Each input is compared against the centroids first and only the codes
+    in its num_probes closest lists are searched exactly.
+    """
+
+    def __init__(
+        self,
+        num_lists=None,
+        num_probes=4,
+        kmeans_iterations=10,
+        seed=0,
+        rebuild_threshold=0.05,
+        memory_budget=None,
+    ):
+        super().__init__(rebuild_threshold, memory_budget)
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+
+    def build(self, codebook):
+        num_lists = self.num_lists or max(1, int(np.sqrt(codebook.shape[0])))
+        self.centroids, assignments = kmeans(
+            codebook, num_lists, self.kmeans_iterations, self.seed
+        )
+        self.inverted_lists = [
+            (assignments == i).nonzero().squeeze(1)
+            for i in range(self.centroids.shape[0])
+        ]
+
+    def search(self, flat_input, codebook):
+        num_lists = self.centroids.shape[0]
+        num_probes = min(self.num_probes, num_lists)
+        row_chunk = self.row_chunk_size(num_lists, flat_input.element_size())
+        row_chunk = row_chunk or flat_input.shape[0]
+        encoding_indices = torch.empty(
+            flat_input.shape[0], dtype=torch.long, device=flat_input.device
+        )
+        for row_start in range(0, flat_input.shape[0], row_chunk):
+            rows = flat_input[row_start : row_start + row_chunk]
+            coarse = calculate_distances(rows, self.centroids)
+            probes = torch.topk(coarse, num_probes, dim=1, largest=False).indices
+            best_distances = torch.full(
+                (rows.shape[0],), float("inf"), device=rows.device
+            )
+            best_indices = torch.zeros(
+                rows.shape[0], dtype=torch.long, device=rows.device
+            )
+            for i, members in enumerate(self.inverted_lists):
+                if members.numel() == 0:
+                    continue
+                queries = (probes == i).any(dim=1).nonzero().squeeze(1)
+                if queries.numel() == 0:
+                    continue
+                distances = calculate_distances(rows[queries], codebook[members])
+                list_indices = torch.argmin(distances, dim=1, keepdim=True)
+                list_distances = distances.gather(1, list_indices).squeeze(1)
+                list_indices = members[list_indices.squeeze(1)]
+                current_distances = best_distances[queries]
+                current_indices = best_indices[queries]
+                # Same tie break as the exact search: lowest index wins
+                closer = (list_distances < current_distances) | (
+                    (list_distances == current_distances)
+                    & (list_indices < current_indices)
+                )
+                best_distances[queries] = torch.where(
+                    closer, list_distances, current_distances
+                )
+                best_indices[queries] = torch.where(
+                    closer, list_indices, current_indices
+                )
+            encoding_indices[row_start : row_start + row_chunk] = best_indices
+        return encoding_indices
+
+
+class PQCodebookSearch(CodebookSearch):
+    """
+    Product quantized search over inverted lists (IVF-PQ).
+    The codebook is clustered into num_lists coarse lists (as in
+    IVFCodebookSearch), each input only considers the codes of its
+    num_probes closest lists. The embedding dimension is split into
+    num_subspaces chunks and each chunk of the codebook is quantized to
+    num_centroids sub-centroids. The candidates are scored through
+    per-subspace lookup tables (asymmetric distance) and the top rerank
+    ones are then re-scored exactly against the current codebook.
+    Work & memory per input are O(num_probes * list size * num_subspaces)
+    instead of O(num_embeddings).
+    """
+
+    def __init__(
+        self,
+        num_subspaces=4,
+        num_centroids=256,
+        rerank=8,
+        num_lists=None,
+        num_probes=4,
+        kmeans_iterations=10,
+        seed=0,
+        rebuild_threshold=0.05,
+        memory_budget=None,
+    ):
+        super().__init__(rebuild_threshold, memory_budget)
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.rerank = rerank
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+
+    def build(self, codebook):
+        if codebook.shape[1] % self.num_subspaces != 0:
+            raise ValueError(
+                f"Embedding dim {codebook.shape[1]} is not divisible by "
+                f"num_subspaces={self.num_subspaces}"
+            )
+        sub_centroids = []
+        codes = []
+        for chunk in codebook.chunk(self.num_subspaces, dim=1):
+            centroids, assignments = kmeans(
+                chunk.contiguous(),
+                self.num_centroids,
+                self.kmeans_iterations,
+                self.seed,
+            )
+            sub_centroids.append(centroids)
+            codes.append(assignments)
+        self.sub_centroids = sub_centroids
+        # (num_embeddings, num_subspaces)
+        self.codes = torch.stack(codes, dim=1)
+
+        # Coarse lists, as a (num_lists, longest list) matrix padded with -1
+        num_lists = self.num_lists or max(1, int(np.sqrt(codebook.shape[0])))
+        self.centroids, assignments = kmeans(
+            codebook, num_lists, self.kmeans_iterations, self.seed
+        )
+        num_lists = self.centroids.shape[0]
+        list_sizes = torch.bincount(assignments, minlength=num_lists)
+        order = torch.argsort(assignments, stable=True)
+        starts = torch.cumsum(list_sizes, dim=0) - list_sizes
+        positions = torch.arange(len(order), device=order.device)
+        positions = positions - starts[assignments[order]]
+        self.list_members = torch.full(
+            (num_lists, int(list_sizes.max())),
+            -1,
+            dtype=torch.long,
+            device=order.device,
+        )
+        self.list_members[assignments[order], positions] = order
+
+    def search(self, flat_input, codebook):
+        num_lists, list_length = self.list_members.shape
+        num_probes = min(self.num_probes, num_lists)
+        num_candidates = num_probes * list_length
+        rerank = min(self.rerank, num_candidates)
+        row_elements = max(num_lists, num_candidates, self.num_centroids)
+        row_chunk = self.row_chunk_size(row_elements, flat_input.element_size())
+        row_chunk = row_chunk or flat_input.shape[0]
+        encoding_indices = torch.empty(
+            flat_input.shape[0], dtype=torch.long, device=flat_input.device
+        )
+        for row_start in range(0, flat_input.shape[0], row_chunk):
+            rows = flat_input[row_start : row_start + row_chunk]
+            # Codes of the closest lists, (rows, num_candidates) with -1 padding
+            coarse = calculate_distances(rows, self.centroids)
+            probes = torch.topk(coarse, num_probes, dim=1, largest=False).indices
+            candidates = self.list_members[probes].flatten(1)
+            is_padding = candidates < 0
+            candidates = candidates.clamp_min(0)
+            # Approximate distance = sum of sub-distances from lookup tables
+            approx = torch.zeros(candidates.shape, device=rows.device)
+            sub_inputs = rows.chunk(self.num_subspaces, dim=1)
+            for m, (sub_input, centroids) in enumerate(
+                zip(sub_inputs, self.sub_centroids)
+            ):
+                table = calculate_distances(sub_input.contiguous(), centroids)
+                approx += table.gather(1, self.codes[candidates, m])
+            approx[is_padding] = float("inf")
+            best_approx = torch.topk(approx, rerank, dim=1, largest=False).indices
+            is_padding = is_padding.gather(1, best_approx)
+            candidates = candidates.gather(1, best_approx)
+            # Exact re-ranking of the candidates
+            # Sorting keeps the lowest index on ties (padding goes last)
+            candidates = torch.where(is_padding, codebook.shape[0], candidates)
+            candidates = candidates.sort(dim=1).values
+            is_padding = candidates == codebook.shape[0]
+            candidates = torch.where(is_padding, 0, candidates)
+            differences = rows.unsqueeze(1) - codebook[candidates]
+            distances = torch.sum(differences ** 2, dim=2)
+            distances[is_padding] = float("inf")
+            best = torch.argmin(distances, dim=1, keepdim=True)
+            encoding_indices[row_start : row_start + row_chunk] = candidates.gather(
+                1, best
+            ).squeeze(1)
+        return encoding_indices
+
+
+codebook_search_backends = {
+    "exact": ExactCodebookSearch,
+    "ivf": IVFCodebookSearch,
+    "pq": PQCodebookSearch,
+}
+
+
 # https://nbviewer.jupyter.org/github/zalandoresearch/pytorch-vq-vae/blob/master/vq-vae.ipynb
 class VectorQuantizerEMA(nn.Module):
     def __init__(
-        self, num_embeddings, embedding_dim, commitment_cost, decay=0.0, epsilon=1e-5
+        self,
+        num_embeddings,
+        embedding_dim,
+        commitment_cost,
+        decay=0.0,
+        epsilon=1e-5,
+        search_memory_budget=None,
+        codebook_search="exact",
+        codebook_search_config=None,
     ):
         super(VectorQuantizerEMA, self).__init__()
 
@@ -22,6 +401,16 @@ class VectorQuantizerEMA(nn.Module):
 
         self._decay = decay
         self._epsilon = epsilon
+        # Nearest neighbour search backend: "exact", "ivf" or "pq"
+        # search_memory_budget bounds the bytes of the distance computations,
+        # temporaries included (an estimate, None = no limit)
+        if isinstance(codebook_search, CodebookSearch):
+            self.codebook_search = codebook_search
+        else:
+            config = codebook_search_config or {}
+            self.codebook_search = codebook_search_backends[codebook_search](
+                memory_budget=search_memory_budget, **config
+            )
 
     def forward(self, inputs):
         # convert inputs from BCHW -> BHWC
@@ -31,38 +420,25 @@ class VectorQuantizerEMA(nn.Module):
         # Flatten input
         flat_input = inputs.view(-1, self._embedding_dim)
 
-        # Calculate distances
-        # Euclidean Distance = Sqrt(Sum(Square(Differences)))
-        # We ignore sqrt because we're taking the nearest neighbor
-        # Which doesn't change when we take sqrt
-        # Since we're working with multi-dimensional matrices
-        # We can get rid of the sum as this is a vectorized operation
-        # So we compute Square(Differences)
-        # I.E. (A - B)^2 = A^2 + B^2 - 2AB
-        distances = (
-            torch.sum(flat_input ** 2, dim=1, keepdim=True)
-            + torch.sum(self._embedding.weight ** 2, dim=1)
-            - 2 * torch.matmul(flat_input, self._embedding.weight.t())
-        )
-
         # Encoding
         # Get Nearest Neighbors
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        # Create a one hot encoded matrix where 1 indicates the nearest neighbor
-        encodings = torch.zeros(
-            encoding_indices.shape[0], self._num_embeddings, device=inputs.device
-        )
-        encodings.scatter_(1, encoding_indices, 1)
+        encoding_indices = self.find_nearest_embeddings(flat_input).unsqueeze(1)
+        # Instead of a one hot encoded matrix, we work with the indices directly
+        # Number of inputs assigned to each embedding vector
+        cluster_counts = torch.bincount(
+            encoding_indices.view(-1), minlength=self._num_embeddings
+        ).to(flat_input.dtype)
 
         # Quantize and unflatten
-        quantized = torch.matmul(encodings, self._embedding.weight).view(input_shape)
+        # Equivalent to multiplying the one hot matrix with the embedding weights
+        quantized = self._embedding(encoding_indices.view(-1)).view(input_shape)
 
         # Use EMA to update the embedding vectors
         if self.training:
             # N_t = N_(t-1) * gamma + n_t * (1 - gamma)
             self._ema_cluster_size = self._ema_cluster_size * self._decay + (
                 1 - self._decay
-            ) * torch.sum(encodings, 0)
+            ) * cluster_counts
 
             # Laplace smoothing of the cluster size
             n = torch.sum(self._ema_cluster_size.data)
@@ -73,6 +449,12 @@ class VectorQuantizerEMA(nn.Module):
             )
 
             # m_t = m_(t-1) * gamma + z_t * (1 - gamma)
+            # Sum of the inputs assigned to each embedding vector
+            # Kept as the one hot matmul (training only): index_add_ sums in
+            # another order, so the EMA weights would drift at rounding level
+            encodings = nn.functional.one_hot(
+                encoding_indices.view(-1), self._num_embeddings
+            ).to(flat_input.dtype)
             dw = torch.matmul(encodings.t(), flat_input)
             self._ema_w = nn.Parameter(
                 self._ema_w * self._decay + (1 - self._decay) * dw
@@ -89,7 +471,7 @@ class VectorQuantizerEMA(nn.Module):
 
         # Straight Through Estimator
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
+        avg_probs = cluster_counts / encoding_indices.shape[0]
         perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
 
         # convert quantized from BHWC -> BCHW
@@ -100,13 +482,27 @@ class VectorQuantizerEMA(nn.Module):
             encoding_indices,
         )
 
+    def find_nearest_embeddings(self, flat_input):
+        # Returns the index of the nearest embedding vector for every input row
+        return self.codebook_search(flat_input, self._embedding.weight)
+
+    def search_recall(self, inputs):
+        """
+        Recall of the search backend against an exact search for a batch of
+        encoder outputs (BCHW). Useful for trading accuracy for throughput.
+        """
+        flat_input = inputs.permute(0, 2, 3, 1).reshape(-1, self._embedding_dim)
+        return self.codebook_search.recall(flat_input, self._embedding.weight)
+
+    def quantize_codes(self, codes):
+        # (B, H, W) grid of codebook indices -> quantized BCHW tensor
+        quantized = self._embedding(codes.long())
+        return quantized.permute(0, 3, 1, 2).contiguous()
+
     def quantize_encoding_indices(self, encoding_indices, target_shape, device):
         # For use in inference/fusion generation
-        encodings = torch.zeros(
-            encoding_indices.shape[0], self._num_embeddings, device=device
-        )
-        encodings.scatter_(1, encoding_indices, 1)
-        quantized = torch.matmul(encodings, self._embedding.weight).view(target_shape)
+        encoding_indices = encoding_indices.to(device).view(-1).long()
+        quantized = self._embedding(encoding_indices).view(target_shape)
         return quantized.permute(0, 3, 1, 2).contiguous()
 
 
@@ -126,6 +522,9 @@ class VQVAE(nn.Module):
         num_embeddings=512,
         commitment_cost=0.25,
         decay=0.99,
+        search_memory_budget=None,
+        codebook_search="exact",
+        codebook_search_config=None,
     ):
         super(VQVAE, self).__init__()
         if small_conv:
@@ -184,7 +583,13 @@ class VQVAE(nn.Module):
 
         # Vector Quantizer
         self.vq_vae = VectorQuantizerEMA(
-            num_embeddings, embedding_dim, commitment_cost, decay
+            num_embeddings,
+            embedding_dim,
+            commitment_cost,
+            decay,
+            search_memory_budget=search_memory_budget,
+            codebook_search=codebook_search,
+            codebook_search_config=codebook_search_config,
         )
 
         # Decoder
@@ -235,6 +640,11 @@ class VQVAE(nn.Module):
                 decoder_layers.append(nn.Sigmoid())
         self.decoder = nn.Sequential(*decoder_layers)
 
+        # Decoder outputs for every codebook vector (see build_decode_table)
+        # Not persistent so checkpoints are unchanged
+        self.register_buffer("decode_table", None, persistent=False)
+        self.decode_table_layers = 0
+
     def calculate_channel_sizes(self, image_channels, max_filters, num_layers):
         channel_sizes = [(image_channels, max_filters // np.power(2, num_layers - 1))]
         for i in range(1, num_layers):
@@ -252,6 +662,100 @@ class VQVAE(nn.Module):
         reconstructed = self.decoder(quantized)
         return loss, reconstructed, perplexity, encodings
 
+    def get_code_dtype(self):
+        # Smallest integer dtype that can hold every codebook index
+        num_embeddings = self.vq_vae._num_embeddings
+        if num_embeddings <= 256:
+            return torch.uint8
+        elif num_embeddings <= 32768:
+            return torch.int16
+        elif num_embeddings <= 2 ** 31:
+            return torch.int32
+        return torch.int64
+
+    def encode(self, x):
+        """
+        Encoder + nearest codebook search only (no decoder, no EMA update).
+        Returns a (B, H, W) grid of codebook indices in the smallest
+        integer dtype that fits num_embeddings.
+        Note that uint8/int16 codes need a .long() before being used as
+        targets or embedding inputs.
+        """
+        encoded = self.encoder(x)
+        batch_size, _, height, width = encoded.shape
+        flat_input = encoded.permute(0, 2, 3, 1).reshape(-1, encoded.shape[1])
+        codes = self.vq_vae.find_nearest_embeddings(flat_input)
+        return codes.view(batch_size, height, width).to(self.get_code_dtype())
+
+    def decode(self, codes):
+        # Takes the (B, H, W) grid returned by encode
+        if self.decode_table is not None and not self.training:
+            # Gather the precomputed outputs of the per pixel decoder layers
+            hidden = nn.functional.embedding(codes.long(), self.decode_table)
+            # BHWC -> BCHW (channels last in memory, which convs accept as is)
+            hidden = hidden.permute(0, 3, 1, 2)
+            return self.decoder[self.decode_table_layers :](hidden)
+        return self.decoder(self.vq_vae.quantize_codes(codes))
+
     def quantize_and_decode(self, x, target_shape, device):
-        quantized = self.vq_vae.quantize_encoding_indices(x, target_shape, device)
-        return self.decoder(quantized)
+        # target_shape is the BHWC shape of the quantized vectors
+        codes = x.to(device).view(target_shape[:-1])
+        return self.decode(codes)
+
+    def count_pointwise_decoder_layers(self):
+        # Number of leading decoder layers that act on each pixel independently
+        count = 0
+        for layer in self.decoder:
+            if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)):
+                if (
+                    layer.kernel_size != (1, 1)
+                    or layer.stride != (1, 1)
+                    or layer.padding != (0, 0)
+                ):
+                    break
+            elif not isinstance(layer, (nn.BatchNorm2d, nn.ReLU, nn.Sigmoid)):
+                break
+            count += 1
+        return count
+
+    def build_decode_table(self):
+        """
+        Runs every codebook vector through the leading 1x1 conv/batch norm/
+        activation layers of the decoder once, so decode only has to gather
+        rows of a (num_embeddings, channels) table instead of running those
+        layers on every pixel.
+        Only used in eval mode. The table is dropped by train() and
+        load_state_dict, call this again after changing the weights.
+        """
+        if self.training:
+            raise RuntimeError("build_decode_table needs the model in eval mode")
+        num_layers = self.count_pointwise_decoder_layers()
+        if num_layers == 0:
+            self.decode_table = None
+            self.decode_table_layers = 0
+            return None
+        codebook = self.vq_vae._embedding.weight
+        with torch.no_grad():
+            table = self.decoder[:num_layers](codebook[:, :, None, None])
+        self.decode_table = table.flatten(1).contiguous()
+        self.decode_table_layers = num_layers
+        return self.decode_table
+
+    def train(self, mode=True):
+        if mode:
+            self.decode_table = None
+        return super(VQVAE, self).train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.decode_table = None
+        return super(VQVAE, self).load_state_dict(*args, **kwargs)
+
+    def optimize_for_inference(self):
+        """
+        Frozen copy with the encoder/decoder batch norms folded into the convs
+        and the decode table built.
+        Only for sampling/encoding, the copy can't be trained.
+        """
+        model = utils.optimize_for_inference(self)
+        model.build_decode_table()
+        return model
@@ -1,30 +1,64 @@
 """
 Train & Test Split:
 We use each Pokemon's pokedex ID as it's unique ID.
-Additionally, we split based on these IDs so as to not contaminate our testing 
-or validation sets. 
+Additionally, we split based on these IDs so as to not contaminate our testing
+or validation sets.
 Thus there may be an uneven split since some Pokemon have female sprites.
 It automatically creates the train/val/test folders and moves the images there.
 
 Preprocessing:
 This script is reponsible for preprocessing the original data folder.
 Since the images are in RGBA, we first need to convert them into RGB images.
-Now we need to decide what color the background should be. 
-White or black are standard, but they may impact how the model sees certain 
+Now we need to decide what color the background should be.
+White or black are standard, but they may impact how the model sees certain
 Pokemon that have very dark or very light shades.
-We follow Gonzalez et. al's approach and use both. 
+We follow Gonzalez et. al's approach and use both.
 In the case of training images, they also used 2 additional noisy backgrounds.
 We repeat the same.
 In terms of image augmentation, we perform horizontal flips as well as rotations in the 15 and 30 degree angles in two directions. We do not rotate the horizontally flipped image though.
+
+Parallelism & Resuming:
+Files are processed by a pool of num_workers processes.
+Every file gets its own seed derived from the global seed, so the output is
+the same (byte for byte) whatever the number of workers or processing order.
+The outputs of every completed file are recorded with their checksums in
+output_dir/manifest.csv, so a rerun (e.g. after a crash) skips finished files.
+utils.data.AugmentedSpriteDataset produces the same data on the fly.
+
+Usage: python preprocess.py input_dir output_dir num_test num_valid
 """
 
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 from PIL import Image
 import sys
 import random
 import numpy as np
+from tqdm import tqdm
 
-def change_background_color(image, color):
+seed = 42
+num_workers = os.cpu_count()  # 1 to process the files serially
+verify_checksums = True  # Re-hash finished outputs on a rerun (False = only check they exist)
+rotations = [15, 30]
+use_noise = True
+do_a_flip = True
+colors = ["white", "black"]
+
+
+def make_noise_background(size, rng):
+    # The bytes of float64 normal samples read as RGBA pixels
+    # (what Image.fromarray(np.random.normal(0, 1, size + (3,)), mode="RGBA") gives)
+    width, height = size
+    noise = rng.normal(0, 1, (width, height, 3)).view(np.uint8)
+    noise = noise.reshape(-1)[: height * width * 4].reshape(height, width, 4)
+    return Image.fromarray(noise, mode="RGBA")
+
+
+def change_background_color(image, color, rng):
     if color == "none":
         return image.convert("RGB")
     if color == "black":
@@ -32,96 +66,188 @@ def change_background_color(image, color):
     elif color == "white":
         background = Image.new("RGBA", image.size, (255, 255, 255))
     else:
-        image_size = image.size + (3,)
-        background = Image.fromarray(np.random.normal(0, 1, image_size), mode="RGBA")
+        background = make_noise_background(image.size, rng)
     return Image.alpha_composite(background, image).convert("RGB")
 
-input_dir = sys.argv[1]
-output_dir = sys.argv[2]
-num_test = int(sys.argv[3])
-num_valid = int(sys.argv[4])
-rotations = [15, 30]
-use_noise = True
-do_a_flip = True
-colors = ["white", "black"]
 
-# Create Folders
-if not os.path.exists(output_dir):
-    os.mkdir(output_dir)
-
-for folder in ["train", "test", "val"]:
-    if not os.path.exists(os.path.join(output_dir, folder)):
-        os.mkdir(os.path.join(output_dir, folder))
-
-# Do a Train-Val-Test Split
-unique = []
-for file in os.listdir(input_dir):
-    file = file.split('.')[0].split("_")[0].split("-")[0]
-    if file not in unique and file not in ["train", "test", "val"]:
-        unique.append(file)
-
-random.shuffle(unique)
-test = set(unique[-num_test:])
-unique = unique[:-num_test]
-val = set(unique[-num_valid:])
-train = set(unique[:-num_valid])
-print(f"Train: {len(train)}\nVal: {len(val)}\nTest: {len(test)}")
-
-all_train = []
-all_val = []
-all_test = []
-for input_file in os.listdir(input_dir):
-    print(input_file)
-    # Load file
-    sprite = Image.open(os.path.join(input_dir, input_file)).convert("RGBA")
+def get_image_id(filename):
+    return filename.split(".")[0].split("_")[0].split("-")[0]
+
 
-    # Find directory to save to
+def get_file_seed(input_file):
+    # Per file seed, independent of which worker gets the file
+    key = f"{seed}:{input_file}".encode()
+    return int.from_bytes(hashlib.sha1(key).digest()[:4], "little")
+
+
+def save_image(image, output_dir, split, output_file):
+    # Returns the relative path & checksum of the written file
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    image_bytes = buffer.getvalue()
+    output_path = os.path.join(split, output_file)
+    with open(os.path.join(output_dir, output_path), "wb") as f:
+        f.write(image_bytes)
+    return output_path, hashlib.sha1(image_bytes).hexdigest()
+
+
+def process_sprite(job):
+    """
+    Writes all the augmented versions of one sprite.
+    Returns the input filename & a list of (output path, checksum).
+    """
+    input_dir, output_dir, input_file, split = job
+    rng = np.random.RandomState(get_file_seed(input_file))
+    sprite = Image.open(os.path.join(input_dir, input_file)).convert("RGBA")
     input_file_name = input_file.split(".")[0]
-    image_id = input_file_name.split("_")[0].split("-")[0]
-    
-    if image_id in test:
-        save_dir = os.path.join(output_dir, "test")
-        all_test.append(image_id)
-    elif image_id in val:
-        save_dir = os.path.join(output_dir, "val")
-        all_val.append(image_id)
-    else:
-        save_dir = os.path.join(output_dir, "train")
-        all_train.append(image_id)
-        if use_noise:
-            colors.extend(["noise1", "noise2"])
-
-    # Augment data
-    for color in colors:
-        rotation = 0
+
+    # Noise backgrounds are only used for the training data
+    sprite_colors = list(colors)
+    if split == "train" and use_noise:
+        sprite_colors += ["noise1", "noise2"]
+
+    # Counter clockwise & clockwise rotations
+    rotated_sprites = []
+    for angle in rotations:
+        rotated_sprites.append((angle, sprite.rotate(angle)))
+        rotated_sprites.append((360 - angle, sprite.rotate(-angle)))
+
+    outputs = []
+    for color in sprite_colors:
         # Change background color & save base image
-        new_sprite = change_background_color(sprite, color)
+        new_sprite = change_background_color(sprite, color, rng)
         output_file = f"{input_file_name}_{color}BG_0rotation.png"
-        new_sprite.save(os.path.join(save_dir, output_file))
+        outputs.append(save_image(new_sprite, output_dir, split, output_file))
 
         # Rotation
-        prev_angle = 0
-        for angle in rotations:
-            # Counter Clockwise Rotation
-            new_angle = np.random.randint(prev_angle, angle)
-            rotated = sprite.rotate(angle)
-            rotated = change_background_color(rotated, color)
-            output_file = f"{input_file_name}_{color}BG_{new_angle}rotation.png"
-            rotated.save(os.path.join(save_dir, output_file))
-            # Clockwise Rotation
-            new_angle = 360 - np.random.randint(prev_angle, angle)
-            rotated = sprite.rotate(angle)
-            rotated = change_background_color(rotated, color)
-            output_file = f"{input_file_name}_{color}BG_{new_angle}rotation.png"
-            rotated.save(os.path.join(save_dir, output_file))
-            # Housekeeping
-            prev_angle = angle
+        for angle, rotated in rotated_sprites:
+            rotated = change_background_color(rotated, color, rng)
+            output_file = f"{input_file_name}_{color}BG_{angle}rotation.png"
+            outputs.append(save_image(rotated, output_dir, split, output_file))
 
         # Horizontal Flip
         if do_a_flip:
             if "noise" in color:
-                new_sprite = change_background_color(sprite, color)
+                new_sprite = change_background_color(sprite, color, rng)
             new_sprite = new_sprite.transpose(Image.FLIP_LEFT_RIGHT)
             output_file = f"{input_file_name}_{color}BG_flipped.png"
-            new_sprite.save(os.path.join(save_dir, output_file))
-print(f"Train: {len(all_train)}\nVal: {len(all_val)}\nTest: {len(all_test)}")
+            outputs.append(save_image(new_sprite, output_dir, split, output_file))
+    return input_file, outputs
+
+
+def get_checksum(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_manifest(manifest_path):
+    # input file -> [(output path, checksum), ...]
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, newline="") as f:
+            for row in csv.reader(f):
+                # Skip the header & a line cut short by a crash
+                if len(row) != 3 or row[0] == "input_file":
+                    continue
+                manifest.setdefault(row[0], []).append((row[1], row[2]))
+    return manifest
+
+
+def is_finished(outputs, output_dir):
+    for output_path, checksum in outputs:
+        path = os.path.join(output_dir, output_path)
+        if not os.path.exists(path):
+            return False
+        if verify_checksums and get_checksum(path) != checksum:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    input_dir = sys.argv[1]
+    output_dir = sys.argv[2]
+    num_test = int(sys.argv[3])
+    num_valid = int(sys.argv[4])
+
+    # Create Folders
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    for folder in ["train", "test", "val"]:
+        if not os.path.exists(os.path.join(output_dir, folder)):
+            os.mkdir(os.path.join(output_dir, folder))
+
+    # A manifest is only valid for the settings it was made with
+    config = {"seed": seed, "num_test": num_test, "num_valid": num_valid}
+    config_path = os.path.join(output_dir, "manifest_config.json")
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) != config:
+                raise ValueError(
+                    f"{output_dir} was made with different settings, use a new output_dir"
+                )
+    else:
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+
+    # Do a Train-Val-Test Split
+    input_files = sorted(os.listdir(input_dir))
+    unique = []
+    for file in input_files:
+        file = get_image_id(file)
+        if file not in unique and file not in ["train", "test", "val"]:
+            unique.append(file)
+
+    random.Random(seed).shuffle(unique)
+    test = set(unique[-num_test:])
+    unique = unique[:-num_test]
+    val = set(unique[-num_valid:])
+    train = set(unique[:-num_valid])
+    print(f"Train: {len(train)}\nVal: {len(val)}\nTest: {len(test)}")
+
+    all_train = []
+    all_val = []
+    all_test = []
+    jobs = []
+    for input_file in input_files:
+        image_id = get_image_id(input_file)
+        if image_id in test:
+            split = "test"
+            all_test.append(image_id)
+        elif image_id in val:
+            split = "val"
+            all_val.append(image_id)
+        else:
+            split = "train"
+            all_train.append(image_id)
+        jobs.append((input_dir, output_dir, input_file, split))
+
+    # Skip the files finished by a previous run
+    manifest_path = os.path.join(output_dir, "manifest.csv")
+    manifest = load_manifest(manifest_path)
+    jobs = [
+        job
+        for job in jobs
+        if job[2] not in manifest or not is_finished(manifest[job[2]], output_dir)
+    ]
+    print(f"Skipping {len(input_files) - len(jobs)} finished files")
+
+    write_header = not os.path.exists(manifest_path)
+    with open(manifest_path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(["input_file", "output_file", "checksum"])
+        if num_workers is not None and num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            results = pool.imap_unordered(process_sprite, jobs, chunksize=4)
+        else:
+            pool = None
+            results = map(process_sprite, jobs)
+        for input_file, outputs in tqdm(results, total=len(jobs)):
+            # Only written once all of a file's outputs are on disk
+            writer.writerows([input_file, path, checksum] for path, checksum in outputs)
+            f.flush()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print(f"Train: {len(all_train)}\nVal: {len(all_val)}\nTest: {len(all_test)}")
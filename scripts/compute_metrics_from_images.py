@@ -5,34 +5,49 @@ Compute the MSE & SSIM scores between the images in them.
 import os
 import sys
 
+import numpy as np
 import torch
 from PIL import Image
 from pytorch_msssim import ssim
-from torchvision import transforms
 from tqdm import tqdm
 
+sys.path.append("./")
+import utils.data as data
+
+batch_size = 256
+
+
+def load_image(path):
+    # (1, H, W, C) uint8 tensor
+    image = torch.from_numpy(np.array(Image.open(path)))
+    if image.dim() == 2:
+        image = image.unsqueeze(-1)
+    return image.unsqueeze(0)
+
 
 def load_images_from_dir(dir, transform):
-    images = []
-    for image in tqdm(os.listdir(dir)):
-        image = Image.open(os.path.join(dir, image))
-        image = transform(image).unsqueeze(0)
-        images.append(image)
-    return torch.cat(images)
+    # Decodes every image into one array, then converts it a batch at a time
+    # into a preallocated tensor (no list of tensors to concatenate)
+    paths = [os.path.join(dir, image) for image in sorted(os.listdir(dir))]
+    try:
+        images = torch.from_numpy(data.load_image_array(paths))
+    except ValueError:
+        # Mixed sizes or modes, transform them one at a time
+        return torch.cat([transform(load_image(path)) for path in tqdm(paths)])
+    if images.dim() == 3:
+        images = images.unsqueeze(-1)
+    output_shape = transform(images[:1]).shape[1:]
+    outputs = torch.empty((len(images),) + output_shape)
+    for i in tqdm(range(0, len(images), batch_size)):
+        outputs[i : i + batch_size] = transform(images[i : i + batch_size])
+    return outputs
 
 
 input_dir = sys.argv[1]
 output_dir = sys.argv[2]
 image_size = int(sys.argv[3])
 
-transform = transforms.Compose(
-    [
-        transforms.ToTensor(),
-        transforms.Resize(
-            image_size, interpolation=transforms.InterpolationMode.BICUBIC
-        ),
-    ]
-)
+transform = data.BatchImageTransform(image_size)
 
 inputs = load_images_from_dir(input_dir, transform)
 print(inputs.shape)
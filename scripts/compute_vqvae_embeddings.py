@@ -28,6 +28,12 @@ vq_vae_num_embeddings = 256
 vq_vae_embedding_dim = 32
 vq_vae_commitment_cost = 0.25
 vq_vae_small_conv = True  # To use the 1x1 convolution layer
+# Approximate peak bytes of the codebook distance computations, temporaries
+# included (an estimate, not a hard cap, None = no limit)
+vq_vae_search_memory_budget = 256 * 1024 * 1024
+# Codebook search backend: "exact", "ivf" or "pq" (approximate for large codebooks)
+vq_vae_codebook_search = "exact"
+vq_vae_codebook_search_config = None  # E.g. {"num_probes": 8} for "ivf"
 vq_vae_embedding_size = vq_vae_image_size // (2 ** vq_vae_num_layers)
 
 # Data Config
@@ -42,6 +48,18 @@ data_folder_lookup = {
 }
 data_folder = data_folder_lookup[dataset]
 pokedex_url = "data\\Pokemon\\pokedex_(Update_04.21).csv"
+# Stream integer codes to fixed size shards instead of keeping everything in memory
+# (read them with data.ShardedCodeDataset, embeddings.pt & encodings.pt aren't written)
+use_streaming_writer = False
+shard_size = 4096
+metadata_columns_lookup = {
+    "pokemon": ["height", "weight", "type1", "type2", "egg1", "egg2"],
+    "tinyhero": ["color"],
+    "sprites": ["id", "pose", "anim"],
+}
+metadata_columns = metadata_columns_lookup[
+    "pokemon" if "pokemon" in dataset else dataset
+]
 
 # Pokedex
 if "pokemon" in dataset:
@@ -60,6 +78,7 @@ if "pokemon" in dataset:
 
 model_prefix = f"outputs\\{vq_vae_experiment_name}"
 model_path = os.path.join(model_prefix, "model.pt")
+shard_output_dir = os.path.join(model_prefix, "embedding_shards")
 
 # Setup Device
 gpu = torch.cuda.is_available()
@@ -92,15 +111,26 @@ model = vqvae.VQVAE(
     commitment_cost=vq_vae_commitment_cost,
     use_max_filters=vq_vae_use_max_filters,
     max_filters=vq_vae_max_filters,
+    search_memory_budget=vq_vae_search_memory_budget,
+    codebook_search=vq_vae_codebook_search,
+    codebook_search_config=vq_vae_codebook_search_config,
 )
 model.load_state_dict(torch.load(model_path, map_location=device))
 model.eval()
 model.to(device)
+if vq_vae_codebook_search != "exact":
+    # Check how much accuracy the approximate search is costing us
+    with torch.no_grad():
+        _, recall_batch = next(iter(input_dataloader))
+        recall_batch = model.encoder(recall_batch.to(device))
+        print(f"Codebook search recall: {model.vq_vae.search_recall(recall_batch)}")
 
 all_embeddings = []
 all_encodings = []
 all_filenames = []
 all_color_ids = []
+if use_streaming_writer:
+    writer = data.ShardedCodeWriter(shard_output_dir, shard_size, metadata_columns)
 with torch.no_grad():
     for iteration, batch in enumerate(tqdm(input_dataloader)):
         # Move batch to device
@@ -109,20 +139,15 @@ with torch.no_grad():
 
         # Get Encodings from vq_vae
         current_batch_size = len(batch)
-        _, _, _, encodings = model(batch)
-        target_shape = (
-            current_batch_size,
-            vq_vae_embedding_size,
-            vq_vae_embedding_size,
-            vq_vae_embedding_dim,
-        )
-        embeddings = model.vq_vae.quantize_encoding_indices(
-            encodings, target_shape, device
-        )
-        # Add embeddings to list
-        all_embeddings.append(embeddings)
-        all_encodings.append(encodings.reshape(current_batch_size, -1))
+        codes = model.encode(batch)
+        if not use_streaming_writer:
+            embeddings = model.vq_vae.quantize_codes(codes)
+            # Add embeddings to list
+            all_embeddings.append(embeddings)
+            all_encodings.append(codes.long().reshape(current_batch_size, -1))
         # Add filenames (with Pokemon name instead of ID) to list
+        batch_filenames = []
+        batch_color_ids = []
         for filename in filenames:
             if "pokemon" in dataset:
                 filename = filename.split("_")[0]
@@ -137,24 +162,39 @@ with torch.no_grad():
                     egg1[pokemon_id_int],
                     egg2[pokemon_id_int],
                 ]
-                all_color_ids.append(colors)
+                batch_color_ids.append(colors)
             elif dataset == "tinyhero":
                 color = filename.split('.')[0].split('_')[1]
-                all_color_ids.append(color)
+                batch_color_ids.append(color)
             elif dataset == "sprites":
                 id, pose, anim = filename.split('.')[0].split('_')
-                all_color_ids.append([id, pose, anim])
-            all_filenames.append(filename)
-# Save to file
-all_embeddings = torch.cat(all_embeddings).detach().cpu()
-all_encodings = torch.cat(all_encodings).detach().cpu().float() / vq_vae_num_embeddings
-
-torch.save(
-    {"embeddings": all_embeddings, "filenames": all_filenames, "color": all_color_ids},
-    os.path.join(model_prefix, f"embeddings.pt"),
-)
-torch.save(
-    {"embeddings": all_encodings, "filenames": all_filenames, "color": all_color_ids},
-    os.path.join(model_prefix, f"encodings.pt"),
-)
+                batch_color_ids.append([id, pose, anim])
+            batch_filenames.append(filename)
+        if use_streaming_writer:
+            writer.add(codes, batch_filenames, batch_color_ids)
+        else:
+            all_filenames.extend(batch_filenames)
+            all_color_ids.extend(batch_color_ids)
+
+if use_streaming_writer:
+    # Embeddings can be rebuilt with data.ShardedCodeDataset(dir, codebook)
+    writer.close(
+        vq_vae_experiment_name=vq_vae_experiment_name,
+        dataset=dataset,
+        num_embeddings=vq_vae_num_embeddings,
+        embedding_dim=vq_vae_embedding_dim,
+    )
+else:
+    # Save to file
+    all_embeddings = torch.cat(all_embeddings).detach().cpu()
+    all_encodings = torch.cat(all_encodings).detach().cpu().float() / vq_vae_num_embeddings
+
+    torch.save(
+        {"embeddings": all_embeddings, "filenames": all_filenames, "color": all_color_ids},
+        os.path.join(model_prefix, f"embeddings.pt"),
+    )
+    torch.save(
+        {"embeddings": all_encodings, "filenames": all_filenames, "color": all_color_ids},
+        os.path.join(model_prefix, f"encodings.pt"),
+    )
 
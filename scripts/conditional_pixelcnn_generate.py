@@ -46,6 +46,7 @@ model_config = {
     "num_classes": vq_vae_model_config["num_embeddings"],
     "kernel_size": 3,
     "use_dilation": True,
+    "crop_kernels": True,  # Checkpoints of either kernel mode load
 }
 model_path = os.path.join(f"outputs\\{model_name}", "model.pt")
 
@@ -54,6 +55,8 @@ image_size = 64
 num_generations = 10000
 batch_size = 32
 num_sample_batches = (num_generations // batch_size) + 1
+# Experimental: re-sample all the pixels in parallel until a fixed point
+use_jacobi_sampling = False
 input_dim = image_size // (2 ** vq_vae_model_config["num_layers"])
 conditioning_info_file = "data\\Pokemon\\metadata.joblib"
 conditioning_info_columns = ["type1", "type2", "shape"]
@@ -78,6 +81,8 @@ vq_vae = vqvae.VQVAE(**vq_vae_model_config)
 vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
 vq_vae.eval()
 vq_vae.to(device)
+# Fold the batch norms, we only need the VQ-VAE for decoding
+vq_vae = vq_vae.optimize_for_inference()
 
 checkpoint = torch.load(model_path, map_location=device)
 label_handler = data.ConditioningLabelsHandlerFromSaved(conditioning_info_file, conditioning_info_columns, checkpoint["encoding_dict"])
@@ -94,18 +99,26 @@ model.eval()
 ################################################################################
 
 # Generate samples
-target_shape = (batch_size, input_dim, input_dim, vq_vae_model_config["embedding_dim"])
 image_shape = (batch_size, model_config["c_in"], input_dim, input_dim)
 for i in tqdm(range(num_sample_batches)):
     with torch.no_grad():
         # Pick some random conditioning info
         conditioning_info = label_handler.sample_conditions(batch_size, sample_conditioning_dict)
         conditioning_info = torch.as_tensor(conditioning_info).float().to(device)
+        # Project the conditions once for every layer & pixel
+        condition_biases = model.prepare_condition(conditioning_info)
         # Sample from model
-        sample = model.sample(image_shape, device, conditioning_info)
+        if use_jacobi_sampling:
+            sample, num_iterations = model.sample_jacobi(
+                image_shape, device, condition_biases=condition_biases
+            )
+            print(f"Jacobi sampling converged in {num_iterations} iterations")
+        else:
+            sample = model.sample(
+                image_shape, device, condition_biases=condition_biases
+            )
         # Feed into VQ-VAE
-        sample = sample.flatten(start_dim=1).view(-1, 1)
-        sample = vq_vae.quantize_and_decode(sample, target_shape, device)
+        sample = vq_vae.decode(sample.squeeze(1))
         # Convert to image
         sample = sample.permute(0, 2, 3, 1).detach().cpu().numpy()
     # Save
@@ -0,0 +1,27 @@
+"""
+Packs the train/val/test folders of a dataset into single memory mapped
+(N, H, W, 3) uint8 files (see utils.data.PackedImageDataset).
+The training scripts also pack on first use, this just does it up front.
+"""
+import os
+import sys
+
+sys.path.append("./")
+import utils.data as data
+
+# Folder with the train/val/test splits
+data_prefix = "data\\Pokemon\\final\\standard"
+# Resize the images while packing (None keeps the original size)
+image_size = 64
+# Output folder, same naming as the training scripts
+if image_size is not None:
+    packed_data_prefix = f"{data_prefix}_packed_{image_size}"
+else:
+    packed_data_prefix = f"{data_prefix}_packed"
+
+for split in ["train", "val", "test"]:
+    pack_dir = os.path.join(packed_data_prefix, split)
+    if os.path.exists(os.path.join(pack_dir, "images.npy")):
+        print(f"{pack_dir} already exists, delete it to repack.")
+        continue
+    data.pack_image_folder(os.path.join(data_prefix, split), pack_dir, image_size)
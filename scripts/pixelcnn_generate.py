@@ -46,6 +46,7 @@ model_config = {
     "num_classes": vq_vae_model_config["num_embeddings"],
     "kernel_size": 3,
     "use_dilation": True,
+    "crop_kernels": True,  # Checkpoints of either kernel mode load
 }
 model_path = os.path.join(f"outputs\\{model_name}", "model.pt")
 
@@ -54,6 +55,8 @@ image_size = 64
 num_generations = 10000
 batch_size = 32
 num_sample_batches = (num_generations // batch_size) + 1
+# Experimental: re-sample all the pixels in parallel until a fixed point
+use_jacobi_sampling = False
 input_dim = image_size // (2 ** vq_vae_model_config["num_layers"])
 output_dir = ""
 
@@ -75,6 +78,8 @@ vq_vae = vqvae.VQVAE(**vq_vae_model_config)
 vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
 vq_vae.eval()
 vq_vae.to(device)
+# Fold the batch norms, we only need the VQ-VAE for decoding
+vq_vae = vq_vae.optimize_for_inference()
 
 checkpoint = torch.load(model_path, map_location=device)
 
@@ -89,15 +94,17 @@ model.eval()
 ################################################################################
 
 # Generate samples
-target_shape = (batch_size, input_dim, input_dim, vq_vae_model_config["embedding_dim"])
 image_shape = (batch_size, model_config["c_in"], input_dim, input_dim)
 for i in tqdm(range(num_sample_batches)):
     with torch.no_grad():
         # Sample from model
-        sample = model.sample(image_shape, device)
+        if use_jacobi_sampling:
+            sample, num_iterations = model.sample_jacobi(image_shape, device)
+            print(f"Jacobi sampling converged in {num_iterations} iterations")
+        else:
+            sample = model.sample(image_shape, device)
         # Feed into VQ-VAE
-        sample = sample.flatten(start_dim=1).view(-1, 1)
-        sample = vq_vae.quantize_and_decode(sample, target_shape, device)
+        sample = vq_vae.decode(sample.squeeze(1))
         # Convert to image
         sample = sample.permute(0, 2, 3, 1).detach().cpu().numpy()
     # Save
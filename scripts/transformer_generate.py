@@ -104,6 +104,8 @@ vq_vae = vqvae.VQVAE(
 vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
 vq_vae.eval()
 vq_vae.to(device)
+# Fold the batch norms, we only need the VQ-VAE for decoding
+vq_vae = vq_vae.optimize_for_inference()
 
 # Create Model
 configuration = GPT2Config(
@@ -60,6 +60,8 @@ model = vae.ConvolutionalVAE(
 model.load_state_dict(torch.load(model_path, map_location=device))
 model.eval()
 model.to(device)
+# Fold the batch norms, we only need the decoder
+model = model.optimize_for_inference()
 
 with torch.no_grad():
     for iteration in tqdm(range(num_sample_batches)):
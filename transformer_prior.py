@@ -56,11 +56,17 @@ batch_size = 32
 
 # Data Config
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 use_noise_images = False
+use_token_cache = False  # Encode the data once & train on cached encodings
+use_packed_data = False  # Read the images from a packed memory mapped file
 data_prefix = "data\\pokemon\\final\\standard"
+packed_data_prefix = f"{data_prefix}_packed"
 output_prefix = f"data\\{experiment_name}"
 vq_vae_model_prefix = f"outputs\\{vq_vae_experiment_name}"
 vq_vae_model_path = os.path.join(vq_vae_model_prefix, "model.pt")
+token_cache_dir = os.path.join(vq_vae_model_prefix, "token_cache")
 
 train_data_folder = os.path.join(data_prefix, "train")
 val_data_folder = os.path.join(data_prefix, "val")
@@ -91,6 +97,22 @@ if not os.path.exists(reconstructed_dir):
 if not os.path.exists(generated_dir):
     os.makedirs(generated_dir)
 
+# Create & Load VQVAE Model
+vq_vae_config = {
+    "num_layers": vq_vae_num_layers,
+    "input_image_dimensions": vq_vae_image_size,
+    "small_conv": vq_vae_small_conv,
+    "embedding_dim": vq_vae_embedding_dim,
+    "num_embeddings": vq_vae_num_embeddings,
+    "commitment_cost": vq_vae_commitment_cost,
+    "use_max_filters": vq_vae_use_max_filters,
+    "max_filters": vq_vae_max_filters,
+}
+vq_vae = vqvae.VQVAE(**vq_vae_config)
+vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
+vq_vae.eval()
+vq_vae.to(device)
+
 ################################################################################
 ################################## Data Setup ##################################
 ################################################################################
@@ -99,32 +121,66 @@ if not os.path.exists(generated_dir):
 transform = data.image2tensor_resize(vq_vae_image_size)
 
 # Load Data
-train_data = data.CustomDatasetNoMemory(train_data_folder, transform, use_noise_images)
-val_data = data.CustomDatasetNoMemory(val_data_folder, transform, use_noise_images)
-test_data = data.CustomDatasetNoMemory(test_data_folder, transform, use_noise_images)
+if use_packed_data:
+    # Packs each split into one memory mapped file the first time
+    train_data = data.load_packed_dataset(
+        train_data_folder, os.path.join(packed_data_prefix, "train"), transform, use_noise_images
+    )
+    val_data = data.load_packed_dataset(
+        val_data_folder, os.path.join(packed_data_prefix, "val"), transform, use_noise_images
+    )
+    test_data = data.load_packed_dataset(
+        test_data_folder, os.path.join(packed_data_prefix, "test"), transform, use_noise_images
+    )
+else:
+    train_data = data.CustomDatasetNoMemory(train_data_folder, transform, use_noise_images)
+    val_data = data.CustomDatasetNoMemory(val_data_folder, transform, use_noise_images)
+    test_data = data.CustomDatasetNoMemory(test_data_folder, transform, use_noise_images)
+
+if use_token_cache:
+    # Encode every image once with the frozen VQ-VAE
+    # The dataloaders then serve the cached encodings instead of images
+    train_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, train_data, token_cache_dir, "train", device
+    )
+    val_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, val_data, token_cache_dir, "val", device
+    )
+    test_loader_data = data.load_token_cache(
+        vq_vae, vq_vae_config, test_data, token_cache_dir, "test", device
+    )
+else:
+    train_loader_data = train_data
+    val_loader_data = val_data
+    test_loader_data = test_data
 
 train_dataloader = torch.utils.data.DataLoader(
-    train_data,
+    train_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 val_dataloader = torch.utils.data.DataLoader(
-    val_data,
+    val_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 test_dataloader = torch.utils.data.DataLoader(
-    test_data,
+    test_loader_data,
     batch_size=batch_size,
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 # Creating a sample set to visualize the model's training
 sample = data.get_samples_from_data(val_data, 16)
 
@@ -132,21 +188,6 @@ sample = data.get_samples_from_data(val_data, 16)
 ##################################### Model ####################################
 ################################################################################
 
-# Create & Load VQVAE Model
-vq_vae = vqvae.VQVAE(
-    num_layers=vq_vae_num_layers,
-    input_image_dimensions=vq_vae_image_size,
-    small_conv=vq_vae_small_conv,
-    embedding_dim=vq_vae_embedding_dim,
-    num_embeddings=vq_vae_num_embeddings,
-    commitment_cost=vq_vae_commitment_cost,
-    use_max_filters=vq_vae_use_max_filters,
-    max_filters=vq_vae_max_filters,
-)
-vq_vae.load_state_dict(torch.load(vq_vae_model_path, map_location=device))
-vq_vae.eval()
-vq_vae.to(device)
-
 # Create Model
 configuration = GPT2Config(
     vocab_size=vocab_size,
@@ -173,12 +214,10 @@ all_val_loss = []
 
 # Get an initial "epoch 0" sample
 model.eval()
-target_shape = (sample.shape[0], image_size, image_size, vq_vae_embedding_dim)
 with torch.no_grad():
-    _, _, _, encodings = vq_vae(sample.to(device))
-    encodings = encodings.reshape(-1, max_seq_length)
-    epoch_sample = model(encodings)["logits"].argmax(dim=2).view(-1, 1)
-    epoch_sample = vq_vae.quantize_and_decode(epoch_sample, target_shape, device)
+    encodings = vq_vae.encode(sample.to(device)).long().flatten(start_dim=1)
+    epoch_sample = model(encodings)["logits"].argmax(dim=2)
+    epoch_sample = vq_vae.decode(epoch_sample.view(-1, image_size, image_size))
 
 # Add sample reconstruction to our list
 all_samples.append(epoch_sample.detach().cpu())
@@ -199,8 +238,10 @@ for epoch in range(epochs):
 
         with torch.no_grad():
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(batch)
-            encodings = encodings.reshape(-1, max_seq_length)
+            if use_token_cache:
+                encodings = batch.long().flatten(start_dim=1)
+            else:
+                encodings = vq_vae.encode(batch).long().flatten(start_dim=1)
 
         # Run our model & get outputs
         loss = model(input_ids=encodings, labels=encodings)["loss"]
@@ -223,8 +264,10 @@ for epoch in range(epochs):
             batch = batch.to(device)
 
             # Get Encodings from vq_vae
-            _, _, _, encodings = vq_vae(batch)
-            encodings = encodings.reshape(-1, max_seq_length)
+            if use_token_cache:
+                encodings = batch.long().flatten(start_dim=1)
+            else:
+                encodings = vq_vae.encode(batch).long().flatten(start_dim=1)
 
             # Run our model & get outputs
             loss = model(input_ids=encodings, labels=encodings)["loss"]
@@ -233,11 +276,9 @@ for epoch in range(epochs):
             val_loss += loss.item()
 
         # Get reconstruction of our sample
-        target_shape = (sample.shape[0], image_size, image_size, vq_vae_embedding_dim)
-        _, _, _, encodings = vq_vae(sample.to(device))
-        encodings = encodings.reshape(-1, max_seq_length)
-        epoch_sample = model(encodings)["logits"].argmax(dim=2).view(-1, 1)
-        epoch_sample = vq_vae.quantize_and_decode(epoch_sample, target_shape, device)
+        encodings = vq_vae.encode(sample.to(device)).long().flatten(start_dim=1)
+        epoch_sample = model(encodings)["logits"].argmax(dim=2)
+        epoch_sample = vq_vae.decode(epoch_sample.view(-1, image_size, image_size))
 
     # Add sample reconstruction to our list
     all_samples.append(epoch_sample.detach().cpu())
@@ -255,6 +296,9 @@ for epoch in range(epochs):
         \nTrain Loss = {train_loss}\
         \nVal Loss = {val_loss}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
@@ -295,8 +339,10 @@ with torch.no_grad():
         batch = batch.to(device)
 
         # Get Encodings from vq_vae
-        _, _, _, encodings = vq_vae(batch)
-        encodings = encodings.reshape(-1, max_seq_length)
+        if use_token_cache:
+            encodings = batch.long().flatten(start_dim=1)
+        else:
+            encodings = vq_vae.encode(batch).long().flatten(start_dim=1)
 
         # Run our model & get outputs
         outputs = model(input_ids=encodings, labels=encodings)
@@ -307,15 +353,8 @@ with torch.no_grad():
         test_loss += loss.item()
 
         # Save
-        target_shape = (
-            reconstructed.shape[0],
-            image_size,
-            image_size,
-            vq_vae_embedding_dim,
-        )
-
-        reconstructed = reconstructed.argmax(dim=2).view(-1, 1)
-        reconstructed = vq_vae.quantize_and_decode(reconstructed, target_shape, device)
+        reconstructed = reconstructed.argmax(dim=2).view(-1, image_size, image_size)
+        reconstructed = vq_vae.decode(reconstructed)
         reconstructed = reconstructed.permute(0, 2, 3, 1).detach().cpu().numpy()
         for image, filename in zip(reconstructed, filenames):
             plt.imsave(os.path.join(reconstructed_dir, filename), image)
@@ -331,12 +370,10 @@ test_sample = data.get_samples_from_data(test_data, 16)
 fig, axis = graphics.make_grid(("Test Sample", test_sample), 4, 4)
 plt.savefig(test_sample_input_name)
 
-target_shape = (test_sample.shape[0], image_size, image_size, vq_vae_embedding_dim)
 with torch.no_grad():
-    _, _, _, encodings = vq_vae(test_sample.to(device))
-    encodings = encodings.reshape(-1, max_seq_length)
-    test_sample = model(encodings)["logits"].argmax(dim=2).view(-1, 1)
-    test_sample = vq_vae.quantize_and_decode(test_sample, target_shape, device)
+    encodings = vq_vae.encode(test_sample.to(device)).long().flatten(start_dim=1)
+    test_sample = model(encodings)["logits"].argmax(dim=2)
+    test_sample = vq_vae.decode(test_sample.view(-1, image_size, image_size))
     reconstructed = test_sample.detach().cpu()
 
 # Plot A Set of Reconstructed Test Images
@@ -345,7 +382,7 @@ plt.savefig(test_sample_output_name)
 
 with torch.no_grad():
     # Get most common pixel values to feed into generation script
-    _, _, _, encodings = vq_vae(sample.to(device))
+    encodings = vq_vae.encode(sample.to(device)).long()
     encodings, counts = encodings.unique(return_counts=True)
     bg1, bg2 = encodings[counts.topk(k=2, largest=True).indices].cpu().numpy()
 
@@ -360,15 +397,7 @@ with torch.no_grad():
             temperature=generation_temperature,
             do_sample=True,
         )
-        target_shape = (
-            generated.shape[0],
-            image_size,
-            image_size,
-            vq_vae_embedding_dim,
-        )
-        generated = vq_vae.quantize_and_decode(
-            generated.view(-1, 1), target_shape, device
-        )
+        generated = vq_vae.decode(generated.view(-1, image_size, image_size))
         generated = generated.permute(0, 2, 3, 1).detach().cpu().numpy()
         for j, image in enumerate(generated):
             filename = f"{(generation_batch_size * i) + j}.png"
@@ -5,9 +5,47 @@ import numpy as np
 import pandas as pd
 import joblib
 import random
+from tqdm import tqdm
 
 from PIL import Image
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
+import time
+
+
+def sample_condition_vectors(num_samples, columns, column_codes, conditioning_size):
+    """
+    Draws a whole batch of n-hot conditioning vectors at once.
+    columns maps a column to 0 (ignore), 1 (always use) or 2 (use 3 times
+    out of 5, for secondary things like type2).
+    column_codes maps a column to the encoded indices of its possible values.
+    """
+    vectors = torch.zeros((num_samples, conditioning_size), dtype=torch.uint8)
+    rows = np.arange(num_samples)
+    for column, column_type in columns.items():
+        if column_type == 0:
+            continue
+        codes = column_codes[column]
+        # Nothing from this column survived encoding
+        if len(codes) == 0:
+            continue
+        choices = codes[np.random.randint(len(codes), size=num_samples)]
+        if column_type == 1:
+            used = rows
+        elif column_type == 2:
+            used = rows[np.random.rand(num_samples) < 0.6]
+        else:
+            continue
+        vectors[used, choices[used]] = 1
+    return vectors
 
 
 class ConditioningLabelsHandler:
@@ -43,18 +81,27 @@ class ConditioningLabelsHandler:
         self.encoding_dict = {y: x for x, y in enumerate(column_unique_values)}
         self.reverse_encoding_dict = {x: y for x, y in enumerate(column_unique_values)}
         self.conditioning_size = len(self.encoding_dict)
+        self.column_codes = {
+            column: np.array([self.encoding_dict[x] for x in values])
+            for column, values in column_unique_values_dict.items()
+        }
+
+        # Precompute the vector of every key, so a batch is a single gather
+        self.key_to_row = {key: i for i, key in enumerate(df.index)}
+        self.label_matrix = torch.zeros(
+            (len(df), self.conditioning_size), dtype=torch.uint8
+        )
+        for label_column in label_columns:
+            codes = df[label_column].map(self.encoding_dict)
+            has_label = codes.notnull().to_numpy()
+            self.label_matrix[
+                np.flatnonzero(has_label), codes[has_label].to_numpy().astype(np.int64)
+            ] = 1
 
     def __call__(self, keys):
-        vectors = []
-        for key in keys:
-            vector = [0] * self.conditioning_size
-            for column in self.label_columns:
-                label_column = self.labels.get(key)
-                # Weird python thing to check for nan
-                if str(label_column[column]) != "nan":
-                    vector[self.encoding_dict[label_column[column]]] = 1
-            vectors.append(vector)
-        return vectors
+        """Returns the (len(keys), conditioning_size) n-hot uint8 vectors"""
+        rows = torch.as_tensor([self.key_to_row[key] for key in keys])
+        return self.label_matrix[rows]
 
     def reverse_transform(self, label):
         label = np.array(label)
@@ -77,23 +124,9 @@ class ConditioningLabelsHandler:
             return [self.reverse_transform(np.flatnonzero(row)) for row in vector]
 
     def sample_conditions(self, num_samples, columns):
-        vectors = []
-        for _ in range(num_samples):
-            vector = [0] * self.conditioning_size
-            for column, column_type in columns.items():
-                # Ignore column
-                if column_type == 0:
-                    pass
-                # Always use column
-                elif column_type == 1:
-                    choice = random.choice(self.column_unique_values_dict[column])
-                    vector[self.encoding_dict[choice]] = 1
-                # Leave it to luck (for secondary things like type2)
-                elif column_type == 2 and random.choice([True, True, True, False, False]):
-                    choice = random.choice(self.column_unique_values_dict[column])
-                    vector[self.encoding_dict[choice]] = 1
-            vectors.append(vector)
-        return vectors
+        return sample_condition_vectors(
+            num_samples, columns, self.column_codes, self.conditioning_size
+        )
 
     def get_size(self):
         """Returns the size of the conditioning vector"""
@@ -133,23 +166,31 @@ class ConditioningLabelsHandlerFromSaved:
         self.encoding_dict = encoding_dict
         self.reverse_encoding_dict = {y: x for x, y in encoding_dict.items()}
         self.conditioning_size = len(self.encoding_dict)
+        # Labels missing from the saved encoding can't be sampled
+        self.column_codes = {
+            column: np.array(
+                [self.encoding_dict[x] for x in values if x in self.encoding_dict]
+            )
+            for column, values in column_unique_values_dict.items()
+        }
 
     def __call__(self, keys):
         if keys.ndim == 0:
             return self.encoding_dict[keys]
-        elif keys.ndim == 1:
-            vector = [0] * self.conditioning_size
-            for key in keys:
-                vector[self.encoding_dict[key]] = 1
-            return vector
-        elif keys.ndim == 2:
-            vectors = []
-            for items in keys: 
-                vector = [0] * self.conditioning_size
-                for key in items:
-                    vector[self.encoding_dict[key]] = 1
-                vectors.append(vector)
-            return vectors
+        # Encode all the labels at once
+        codes = pd.Series(keys.ravel()).map(self.encoding_dict)
+        if codes.isnull().any():
+            unknown = keys.ravel()[codes.isnull().to_numpy()]
+            missing = sorted({str(x) for x in unknown})
+            raise KeyError(f"Labels not in the encoding: {missing}")
+        codes = codes.to_numpy()
+        codes = torch.as_tensor(codes.astype(np.int64)).view(-1, keys.shape[-1])
+        vectors = torch.zeros(
+            (len(codes), self.conditioning_size), dtype=torch.uint8
+        ).scatter_(1, codes, 1)
+        if keys.ndim == 1:
+            return vectors[0]
+        return vectors
 
     def reverse_transform(self, label):
         label = np.array(label)
@@ -172,23 +213,9 @@ class ConditioningLabelsHandlerFromSaved:
             return [self.reverse_transform(np.flatnonzero(row)) for row in vector]
 
     def sample_conditions(self, num_samples, columns):
-        vectors = []
-        for _ in range(num_samples):
-            vector = [0] * self.conditioning_size
-            for column, column_type in columns.items():
-                # Ignore column
-                if column_type == 0:
-                    pass
-                # Always use column
-                elif column_type == 1:
-                    choice = random.choice(self.column_unique_values_dict[column])
-                    vector[self.encoding_dict[choice]] = 1
-                # Leave it to luck (for secondary things like type2)
-                elif column_type == 2 and random.choice([True, True, True, False, False]):
-                    choice = random.choice(self.column_unique_values_dict[column])
-                    vector[self.encoding_dict[choice]] = 1
-            vectors.append(vector)
-        return vectors
+        return sample_condition_vectors(
+            num_samples, columns, self.column_codes, self.conditioning_size
+        )
 
     def get_size(self):
         """Returns the size of the conditioning vector"""
@@ -197,6 +224,8 @@ class ConditioningLabelsHandlerFromSaved:
 class CustomDataset(torch.utils.data.Dataset):
     """
     Requires the dataset as a dict of form filename:image.
+    Images can be PaletteImages (see load_images_from_folder), without a
+    transform they are then expanded by BatchImageTransform.collate.
     Returns filename, image
     """
 
@@ -209,6 +238,8 @@ class CustomDataset(torch.utils.data.Dataset):
         data = self.dataset[index]
         key = self.keys[index]
         if self.transform is not None:
+            if isinstance(data, PaletteImage):
+                data = np.asarray(data)
             data = self.transform(data)
         return key, data
 
@@ -459,6 +490,150 @@ class EverythingDataset(torch.utils.data.Dataset):
         return len(self.all_images)
 
 
+def get_transform_signature(transform):
+    # Compose & the torchvision transforms have a repr listing their parameters
+    return repr(transform)
+
+
+class SharedImageCache:
+    """
+    LRU cache of transformed images, shared by the DataLoader worker processes.
+    Entries live in one shared memory tensor of max_bytes // item bytes
+    slots, so only images of item_shape/dtype are cached.
+    The slots are split into sets of `ways` slots: a key can only go in the
+    set its hash points to (LRU within the set), so a lookup scans `ways`
+    slots & only takes the lock of that set's stripe (num_locks stripes).
+    The shared memory is allocated without being written, so pages are only
+    used as slots fill up.
+    With shared=False (e.g. num_workers=0) it's a plain in-process LRU dict.
+    Keys are (path, transform signature) so datasets with different
+    transforms can share a cache.
+    Use get_stats() to see the hit/miss counts when sizing max_bytes.
+    multiprocessing_context has to match the DataLoader's if that one is set.
+    """
+
+    def __init__(
+        self,
+        max_bytes,
+        item_shape,
+        dtype=torch.float32,
+        multiprocessing_context=None,
+        shared=True,
+        ways=8,
+        num_locks=16,
+    ):
+        self.item_shape = torch.Size(item_shape)
+        self.dtype = dtype
+        self.shared = shared
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        item_bytes = self.item_shape.numel() * element_size
+        capacity = max_bytes // item_bytes
+        self.ways = max(1, min(ways, capacity))
+        self.num_sets = capacity // self.ways
+        self.capacity = self.num_sets * self.ways
+        if not shared:
+            self.entries = collections.OrderedDict()
+            self.counters = [0, 0]  # Hits, misses
+            return
+
+        storage = torch.UntypedStorage._new_shared(self.capacity * item_bytes)
+        self.images = torch.empty(0, dtype=dtype).set_(storage)
+        self.images = self.images.view(self.capacity, *self.item_shape)
+        self.keys = torch.full((self.num_sets, self.ways), -1, dtype=torch.int64)
+        # Empty slots (-1) are the first to be used
+        self.last_used = torch.full((self.num_sets, self.ways), -1, dtype=torch.int64)
+        num_locks = max(1, min(num_locks, self.num_sets))
+        # Hits & misses of every lock stripe
+        self.counters = torch.zeros((num_locks, 2), dtype=torch.int64)
+        for tensor in [self.keys, self.last_used, self.counters]:
+            tensor.share_memory_()
+        context = multiprocessing.get_context(multiprocessing_context)
+        self.locks = [context.Lock() for _ in range(num_locks)]
+
+    def hash_key(self, path, transform):
+        # Python's hash() changes between (spawned) processes, this doesn't
+        key = f"{path}|{get_transform_signature(transform)}".encode()
+        return int.from_bytes(hashlib.sha1(key).digest()[:8], "little") >> 1
+
+    def get_set(self, key):
+        # Set the key goes in & the lock stripe of that set
+        cache_set = key % self.num_sets
+        return cache_set, cache_set % len(self.locks)
+
+    def find_way(self, cache_set, key):
+        # Slot of the key in its set, None if it isn't cached
+        ways = (self.keys[cache_set] == key).nonzero()
+        return int(ways[0, 0]) if len(ways) > 0 else None
+
+    def get(self, path, transform):
+        """Returns a copy of the cached image or None"""
+        if self.capacity == 0:
+            return None
+        key = self.hash_key(path, transform)
+        if not self.shared:
+            image = self.entries.get(key)
+            self.counters[image is None] += 1
+            if image is None:
+                return None
+            self.entries.move_to_end(key)
+            return image.clone()
+        cache_set, stripe = self.get_set(key)
+        with self.locks[stripe]:
+            way = self.find_way(cache_set, key)
+            if way is None:
+                self.counters[stripe, 1] += 1
+                return None
+            self.counters[stripe, 0] += 1
+            self.last_used[cache_set, way] = self.last_used[cache_set].max() + 1
+            return self.images[cache_set * self.ways + way].clone()
+
+    def put(self, path, transform, image):
+        if self.capacity == 0:
+            return
+        if image.shape != self.item_shape or image.dtype != self.dtype:
+            return
+        key = self.hash_key(path, transform)
+        if not self.shared:
+            self.entries[key] = image.clone()
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return
+        cache_set, stripe = self.get_set(key)
+        with self.locks[stripe]:
+            if self.find_way(cache_set, key) is not None:
+                # Another worker got there first
+                return
+            # Replace the least recently used slot of the set
+            way = int(self.last_used[cache_set].argmin())
+            self.images[cache_set * self.ways + way].copy_(image)
+            self.keys[cache_set, way] = key
+            self.last_used[cache_set, way] = self.last_used[cache_set].max() + 1
+
+    def load(self, path, transform):
+        """Cached version of transform(Image.open(path).convert("RGB"))"""
+        image = self.get(path, transform)
+        if image is None:
+            image = transform(Image.open(path).convert("RGB"))
+            self.put(path, transform, image)
+        return image
+
+    def get_stats(self):
+        if self.shared:
+            hits, misses = [int(x) for x in self.counters.sum(dim=0)]
+            size = int((self.keys != -1).sum())
+        else:
+            hits, misses = self.counters
+            size = len(self.entries)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / max(hits + misses, 1),
+            "size": size,
+            "capacity": self.capacity,
+        }
+
+
 class FusionDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -467,10 +642,13 @@ class FusionDataset(torch.utils.data.Dataset):
         base_val_images,
         base_test_images,
         transform,
+        image_cache=None,
     ):
         self.dataset_path = fusion_dataset_path
         self.all_images = os.listdir(fusion_dataset_path)
         self.transform = transform
+        # Optional SharedImageCache for the transformed base images
+        self.image_cache = image_cache
 
         self.base_dataset = [base_train_images, base_val_images, base_test_images]
 
@@ -489,6 +667,15 @@ class FusionDataset(torch.utils.data.Dataset):
                     return dataset[filename], filename
         return None, None
 
+    def transform_base_image(self, image, filename):
+        if self.image_cache is None:
+            return self.transform(image)
+        transformed = self.image_cache.get(filename, self.transform)
+        if transformed is None:
+            transformed = self.transform(image)
+            self.image_cache.put(filename, self.transform, transformed)
+        return transformed
+
     def __getitem__(self, index):
         fusion_filename = self.all_images[index]
         # Get two base names
@@ -497,10 +684,10 @@ class FusionDataset(torch.utils.data.Dataset):
         second = self.to_3_digit(second)
         # Get Base
         image, base_filename = self.get_base_image(first, background)
-        base = self.transform(image)
+        base = self.transform_base_image(image, base_filename)
         # Get Fusee
         image, fusee_filename = self.get_base_image(second, background)
-        fusee = self.transform(image)
+        fusee = self.transform_base_image(image, fusee_filename)
         # Get Fusion
         fusion_loc = os.path.join(self.dataset_path, fusion_filename)
         image = Image.open(fusion_loc).convert("RGB")
@@ -524,16 +711,16 @@ class CombinedDataset(torch.utils.data.Dataset):
             all_images = os.listdir(fusion_dataset_path)
             self.fusion_images = [x for x in all_images if "noise" not in x]
         self.all_images = self.base_images + self.fusion_images
+        # Base images come first, so the position tells us the folder
+        self.num_base_images = len(self.base_images)
         self.transform = transform
 
     def __getitem__(self, index):
         filename = self.all_images[index]
-        if filename in self.base_images:
+        if index < self.num_base_images:
             filepath = os.path.join(self.dataset_path, filename)
-        elif filename in self.fusion_images:
-            filepath = os.path.join(self.fusion_dataset_path, filename)
         else:
-            raise ValueError(f"Could not find file: {filename}")
+            filepath = os.path.join(self.fusion_dataset_path, filename)
         image = Image.open(filepath).convert("RGB")
         image = self.transform(image)
         return filename, image
@@ -551,6 +738,7 @@ class FusionDatasetV2(torch.utils.data.Dataset):
         transform,
         use_noise_images,
         only_fusions=False,
+        image_cache=None,
     ):
         self.dataset_path = dataset_path
         self.fusion_dataset_path = fusion_dataset_path
@@ -581,65 +769,1045 @@ class FusionDatasetV2(torch.utils.data.Dataset):
         else:
             self.all_images = self.base_images + self.fusion_images
         self.transform = transform
+        # Optional SharedImageCache for the transformed base images
+        self.image_cache = image_cache
+        self.build_index(0 if only_fusions else len(self.base_images))
 
     def to_3_digit(self, num):
         return "0" * (3 - len(num)) + num
 
+    def build_index(self, num_base_images):
+        """
+        Resolves every item once so __getitem__ is only lookups.
+        kinds: 0 for a base image, 1 for a fusion.
+        base_ids/fusee_ids/fusion_ids: positions in image_paths/image_names
+        (-1 if the base image of a fusion couldn't be found).
+        background_ids: positions in backgrounds (-1 for base images).
+        """
+        self.image_paths = []
+        self.image_names = []
+        self.backgrounds = []
+        self.base_image_lookup = {}
+        background_lookup = {}
+        num_items = len(self.all_images)
+        self.kinds = np.zeros(num_items, dtype=np.uint8)
+        self.base_ids = np.full(num_items, -1, dtype=np.int32)
+        self.fusee_ids = np.full(num_items, -1, dtype=np.int32)
+        self.fusion_ids = np.full(num_items, -1, dtype=np.int32)
+        self.background_ids = np.full(num_items, -1, dtype=np.int16)
+        for i, filename in enumerate(self.all_images):
+            if i < num_base_images:
+                # Normal image, base = fusee = fusion
+                image_id = self.add_image(
+                    os.path.join(self.dataset_path, filename), filename
+                )
+                self.base_ids[i] = self.fusee_ids[i] = self.fusion_ids[i] = image_id
+                continue
+            # Fusion, get the two base names
+            base, fusee, background, _ = filename.split(".")
+            if background not in background_lookup:
+                background_lookup[background] = len(self.backgrounds)
+                self.backgrounds.append(background)
+            self.kinds[i] = 1
+            self.base_ids[i] = self.find_base_image(self.to_3_digit(base), background)
+            self.fusee_ids[i] = self.find_base_image(self.to_3_digit(fusee), background)
+            self.fusion_ids[i] = self.add_image(
+                os.path.join(self.fusion_dataset_path, filename), filename
+            )
+            self.background_ids[i] = background_lookup[background]
+
+    def add_image(self, filepath, filename):
+        self.image_paths.append(filepath)
+        self.image_names.append(filename)
+        return len(self.image_paths) - 1
+
+    def find_base_image(self, num, background):
+        # Memoized, a few hundred bases are shared by all the fusions
+        key = (num, background)
+        if key not in self.base_image_lookup:
+            self.base_image_lookup[key] = -1
+            # if Base BW is not there, search for female BW
+            filenames = [
+                f"{num}_base_bw_{background}_0rotation.png",
+                f"{num}_base_female_bw_{background}_0rotation.png",
+            ]
+            for dataset in self.all_data:
+                for filename in filenames:
+                    if filename in self.all_data[dataset]:
+                        filepath = os.path.join(
+                            self.dataset_parent_dir, dataset, filename
+                        )
+                        self.base_image_lookup[key] = self.add_image(
+                            filepath, filename
+                        )
+                        break
+                if self.base_image_lookup[key] != -1:
+                    break
+        return self.base_image_lookup[key]
+
     def get_base_image(self, num, background):
-        # if Base BW is not there, search for female BW
-        filenames = [
-            f"{num}_base_bw_{background}_0rotation.png",
-            f"{num}_base_female_bw_{background}_0rotation.png",
-        ]
-        for dataset in self.all_data:
-            for filename in filenames:
-                if filename in self.all_data[dataset]:
-                    filepath = os.path.join(self.dataset_parent_dir, dataset, filename)
-                    image = Image.open(filepath).convert("RGB")
-                    return image, filename
-        return None, None
+        image_id = self.find_base_image(num, background)
+        if image_id == -1:
+            return None, None
+        image = Image.open(self.image_paths[image_id]).convert("RGB")
+        return image, self.image_names[image_id]
+
+    def load_image(self, image_id, use_cache=True):
+        if use_cache and self.image_cache is not None:
+            return self.image_cache.load(self.image_paths[image_id], self.transform)
+        image = Image.open(self.image_paths[image_id]).convert("RGB")
+        return self.transform(image)
 
     def __getitem__(self, index):
-        filename = self.all_images[index]
-        if filename in self.base_images:
+        base_id = self.base_ids[index]
+        fusee_id = self.fusee_ids[index]
+        fusion_id = self.fusion_ids[index]
+        if base_id == -1 or fusee_id == -1:
+            raise ValueError(
+                f"Could not find the base images of: {self.all_images[index]}"
+            )
+        if self.kinds[index] == 0:
             # If normal image
-            filepath = os.path.join(self.dataset_path, filename)
-            image = Image.open(filepath).convert("RGB")
-            image = self.transform(image)
-            base_name = fusee_name = fusion_name = filename
+            image = self.load_image(base_id)
             base = fusee = fusion = image
-        elif filename in self.fusion_images:
-            # If fusion
-            # Get two base names
-            base, fusee, background, _ = filename.split(".")
-            base = self.to_3_digit(base)
-            fusee = self.to_3_digit(fusee)
-            # Get Base
-            base, base_name = self.get_base_image(base, background)
-            base = self.transform(base)
-            # Get Fusee
-            fusee, fusee_name = self.get_base_image(fusee, background)
-            fusee = self.transform(fusee)
-            # Get Fusion
-            fusion_name = filename
-            fusion = os.path.join(self.fusion_dataset_path, fusion_name)
-            fusion = Image.open(fusion).convert("RGB")
-            fusion = self.transform(fusion)
         else:
-            raise ValueError(f"Could not find file: {filename}")
-        return (base_name, fusee_name, fusion_name), (base, fusee, fusion)
+            base = self.load_image(base_id)
+            fusee = self.load_image(fusee_id)
+            # Every fusion is unique, no point caching it
+            fusion = self.load_image(fusion_id, use_cache=False)
+        names = (
+            self.image_names[base_id],
+            self.image_names[fusee_id],
+            self.image_names[fusion_id],
+        )
+        return names, (base, fusee, fusion)
+
+    def get_indices(self, mode):
+        """
+        Items of a mode, from the index (nothing is loaded):
+        "standard" for base images, "fusion" for fusions of two different
+        base images. Items whose base images are missing are left out.
+        """
+        found = (self.base_ids != -1) & (self.fusee_ids != -1)
+        if mode == "standard":
+            mask = found & (self.kinds == 0)
+        elif mode == "fusion":
+            mask = found & (self.kinds == 1) & (self.base_ids != self.fusee_ids)
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+        return np.flatnonzero(mask)
 
     def __len__(self):
         return len(self.all_images)
 
 
-def load_images_from_folder(folder, use_noise_images):
-    dataset = {}
-    for file in os.listdir(folder):
-        if "noise" in file and not use_noise_images:
-            continue
-        image = Image.open(os.path.join(folder, file))
-        dataset[file] = np.array(image)
+def get_sprite_id(filename):
+    # Pokedex ID of a sprite file, e.g. "25-female_shiny.png" -> "25"
+    return filename.split(".")[0].split("_")[0].split("-")[0]
+
+
+def split_sprite_ids(input_dir, num_test, num_valid, seed=None):
+    """
+    Train/val/test split by pokedex ID, same as preprocess.py.
+    Returns {"train": ids, "val": ids, "test": ids}.
+    """
+    unique = []
+    for file in sorted(os.listdir(input_dir)):
+        image_id = get_sprite_id(file)
+        if image_id not in unique and image_id not in ["train", "test", "val"]:
+            unique.append(image_id)
+    random.Random(seed).shuffle(unique)
+    test = set(unique[-num_test:])
+    unique = unique[:-num_test]
+    val = set(unique[-num_valid:])
+    train = set(unique[:-num_valid])
+    return {"train": train, "val": val, "test": test}
+
+
+def get_sprite_variants(colors, rotations, do_a_flip, use_noise):
+    """
+    The (background, angle, flip) variants preprocess.py saves for every
+    sprite. Angles are counter clockwise degrees, each rotation is done in
+    both directions. use_noise adds the two noise backgrounds (training data).
+    """
+    colors = list(colors)
+    if use_noise:
+        colors += ["noise1", "noise2"]
+    variants = []
+    for color in colors:
+        variants.append((color, 0, False))
+        for angle in rotations:
+            variants.append((color, angle, False))
+            variants.append((color, 360 - angle, False))
+        if do_a_flip:
+            variants.append((color, 0, True))
+    return variants
+
+
+def make_noise_background(height, width, rng):
+    # Same noise as preprocess.change_background_color:
+    # the bytes of float64 normal samples read as RGBA pixels
+    noise = rng.normal(0, 1, (width, height, 3)).view(np.uint8)
+    return noise.reshape(-1)[: height * width * 4].reshape(height, width, 4)
+
+
+def rotate_images(images, angles):
+    """
+    Batched version of PIL's Image.rotate (counter clockwise degrees,
+    nearest neighbour, same size, zero fill) for (B, C, H, W) tensors.
+    """
+    height, width = images.shape[-2:]
+    radians = torch.deg2rad(angles.to(images.dtype))
+    cos, sin = torch.cos(radians), torch.sin(radians)
+    theta = torch.zeros((len(images), 2, 3), dtype=images.dtype)
+    theta[:, 0, 0] = cos
+    theta[:, 0, 1] = -sin * height / width
+    theta[:, 1, 0] = sin * width / height
+    theta[:, 1, 1] = cos
+    grid = nn.functional.affine_grid(theta, images.shape, align_corners=False)
+    return nn.functional.grid_sample(
+        images, grid, mode="nearest", padding_mode="zeros", align_corners=False
+    )
+
+
+def alpha_composite(foreground, background):
+    """
+    Batched version of PIL's Image.alpha_composite(background, foreground)
+    followed by .convert("RGB"), for (B, 4, H, W) RGBA tensors in [0, 1].
+    """
+    foreground_alpha = foreground[:, 3:]
+    background_alpha = background[:, 3:] * (1 - foreground_alpha)
+    alpha = foreground_alpha + background_alpha
+    rgb = foreground[:, :3] * foreground_alpha + background[:, :3] * background_alpha
+    # Like PIL, fully transparent pixels keep the background colour
+    return torch.where(alpha > 0, rgb / alpha.clamp(min=1e-8), background[:, :3])
+
+
+class AugmentedSpriteDataset(torch.utils.data.Dataset):
+    """
+    On the fly replacement for the augmented folders written by preprocess.py.
+    The original RGBA sprites are loaded once. Every item is a (sprite, variant)
+    pair that gets composited onto its background, rotated & flipped at load time.
+    DataLoaders (torch >= 2.0) fetch whole batches through __getitems__,
+    so this runs once per batch on tensors.
+    Noise backgrounds only depend on seed & the item index, so the data is
+    the same every epoch and with any number of workers.
+    Returns filename (named like preprocess.py's output), image.
+    """
+
+    def __init__(
+        self,
+        input_dir,
+        image_ids=None,
+        use_noise=False,
+        image_size=None,
+        colors=("white", "black"),
+        rotations=(15, 30),
+        do_a_flip=True,
+        seed=0,
+    ):
+        filenames = sorted(os.listdir(input_dir))
+        if image_ids is not None:
+            filenames = [x for x in filenames if get_sprite_id(x) in image_ids]
+        self.filenames = filenames
+        sprites = [
+            np.asarray(Image.open(os.path.join(input_dir, x)).convert("RGBA"))
+            for x in tqdm(filenames, desc="Loading sprites")
+        ]
+        # (N, 4, H, W) uint8
+        self.sprites = torch.from_numpy(np.stack(sprites)).permute(0, 3, 1, 2)
+        self.variants = get_sprite_variants(colors, rotations, do_a_flip, use_noise)
+        self.resize = None
+        if image_size is not None:
+            self.resize = transforms.Resize(
+                image_size, interpolation=transforms.InterpolationMode.BICUBIC
+            )
+        self.seed = seed
+
+    def get_filename(self, sprite_index, variant_index):
+        name = self.filenames[sprite_index].split(".")[0]
+        color, angle, flip = self.variants[variant_index]
+        if flip:
+            return f"{name}_{color}BG_flipped.png"
+        return f"{name}_{color}BG_{angle}rotation.png"
+
+    def get_backgrounds(self, indices, variant_indices, height, width):
+        backgrounds = torch.zeros((len(indices), 4, height, width))
+        for i, (index, variant_index) in enumerate(zip(indices, variant_indices)):
+            color = self.variants[variant_index][0]
+            if color == "white":
+                backgrounds[i] = 1
+            elif color == "black":
+                backgrounds[i, 3] = 1
+            else:
+                rng = np.random.default_rng([self.seed, int(index)])
+                noise = make_noise_background(height, width, rng)
+                backgrounds[i] = torch.from_numpy(noise).permute(2, 0, 1) / 255
+        return backgrounds
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        sprite_indices = indices // len(self.variants)
+        variant_indices = indices % len(self.variants)
+        sprites = self.sprites[sprite_indices].float().div_(255)
+        angles = torch.tensor([float(self.variants[x][1]) for x in variant_indices])
+        flips = torch.tensor([self.variants[x][2] for x in variant_indices])
+
+        # Rotate the sprite first so the corners show the background
+        rotated = angles != 0
+        if rotated.any():
+            sprites[rotated] = rotate_images(sprites[rotated], angles[rotated])
+        backgrounds = self.get_backgrounds(indices, variant_indices, *sprites.shape[-2:])
+        images = alpha_composite(sprites, backgrounds)
+        if flips.any():
+            images[flips] = images[flips].flip(-1)
+        if self.resize is not None:
+            images = self.resize(images)
+        return [
+            (self.get_filename(sprite_index, variant_index), image)
+            for sprite_index, variant_index, image in zip(
+                sprite_indices, variant_indices, images
+            )
+        ]
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __len__(self):
+        return len(self.sprites) * len(self.variants)
+
+
+def get_foreground_box(image):
+    """
+    Bounding box (top, left, bottom, right) of the pixels that differ from
+    the background colour (the top left pixel), bottom & right exclusive.
+    Noise backgrounds give the whole image, blank images (0, 0, 0, 0).
+    """
+    foreground = image != image[0, 0]
+    if foreground.ndim == 3:
+        foreground = foreground.any(axis=-1)
+    rows = np.flatnonzero(foreground.any(axis=1))
+    columns = np.flatnonzero(foreground.any(axis=0))
+    if len(rows) == 0:
+        return 0, 0, 0, 0
+    return rows[0], columns[0], rows[-1] + 1, columns[-1] + 1
+
+
+def scale_boxes(boxes, image_shape, size, padding=0):
+    """
+    Rescales (N, 4) boxes of (height, width) images to a size x size grid
+    (e.g. the VQ-VAE encodings), rounding outwards & adding padding cells
+    on every side. Blank boxes stay blank.
+    """
+    height, width = image_shape
+    boxes = np.asarray(boxes, dtype=np.float64)
+    scale = np.array([size / height, size / width] * 2)
+    scaled = boxes * scale
+    scaled[:, :2] = np.floor(scaled[:, :2]) - padding
+    scaled[:, 2:] = np.ceil(scaled[:, 2:]) + padding
+    scaled = np.clip(scaled, 0, size).astype(np.int16)
+    blank = (boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1])
+    scaled[blank] = 0
+    return scaled
+
+
+def scale_box(box, image_shape, new_shape):
+    # One box from an image_shape image to a new_shape one, rounding outwards
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return 0, 0, 0, 0
+    scale = np.array([new_shape[0] / image_shape[0], new_shape[1] / image_shape[1]] * 2)
+    scaled = np.asarray(box, dtype=np.float64) * scale
+    top, left = np.floor(scaled[:2]).astype(int)
+    bottom, right = np.ceil(scaled[2:]).astype(int)
+    return top, left, min(bottom, new_shape[0]), min(right, new_shape[1])
+
+
+def get_box_mask(boxes, height, width):
+    """(N, height, width) bool tensor, True inside the (N, 4) boxes"""
+    boxes = torch.as_tensor(boxes).long()
+    top, left, bottom, right = [x[:, None, None] for x in boxes.unbind(dim=1)]
+    rows = torch.arange(height)[None, :, None]
+    columns = torch.arange(width)[None, None, :]
+    return (rows >= top) & (rows < bottom) & (columns >= left) & (columns < right)
+
+
+class BoundingBoxBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that puts sprites whose foreground boxes end on similar
+    rows in the same batch (random order within equal rows & between batches).
+    Autoregressive priors that ignore the background can then drop every
+    row below the lowest box of the batch.
+    """
+
+    def __init__(self, boxes, batch_size, shuffle=True, drop_last=False):
+        self.bottoms = np.asarray(boxes)[:, 2]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.bottoms))
+        else:
+            order = np.arange(len(self.bottoms))
+        order = order[np.argsort(self.bottoms[order], kind="stable")]
+        batches = [
+            order[i : i + self.batch_size]
+            for i in range(0, len(order), self.batch_size)
+        ]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.bottoms) // self.batch_size
+        return (len(self.bottoms) + self.batch_size - 1) // self.batch_size
+
+
+def pack_image_folder(folder, pack_dir, image_size=None):
+    """
+    One time conversion of a folder of images into a single contiguous
+    (N, H, W, 3) uint8 .npy file plus the list of filenames.
+    The foreground box of every image (get_foreground_box) goes to boxes.npy.
+    If image_size is given, images are resized (bicubic, smaller edge) while
+    packing, otherwise all images need the same size. Boxes are found on the
+    original images and scaled outwards to the packed size, since resampling
+    smears the background.
+    images.npy is moved into place last, so its presence marks a complete pack.
+    """
+    filenames = sorted(os.listdir(folder))
+    if len(filenames) == 0:
+        raise ValueError(f"No images found in {folder}")
+    if not os.path.exists(pack_dir):
+        os.makedirs(pack_dir)
+    temp_path = os.path.join(pack_dir, "images.tmp.npy")
+    images = None
+    boxes = np.zeros((len(filenames), 4), dtype=np.int16)
+    for i, filename in enumerate(tqdm(filenames, desc=f"Packing {folder}")):
+        image = Image.open(os.path.join(folder, filename)).convert("RGB")
+        box = get_foreground_box(np.asarray(image))
+        if image_size is not None:
+            height, width = get_resized_shape(image.height, image.width, image_size)
+            if (height, width) != (image.height, image.width):
+                box = scale_box(box, (image.height, image.width), (height, width))
+                image = image.resize((width, height), Image.BICUBIC)
+        image = np.asarray(image)
+        if images is None:
+            images = np.lib.format.open_memmap(
+                temp_path,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(filenames),) + image.shape,
+            )
+        elif image.shape != images.shape[1:]:
+            raise ValueError(
+                f"{filename} has shape {image.shape}, expected {images.shape[1:]}"
+            )
+        images[i] = image
+        boxes[i] = box
+    images.flush()
+    del images
+    np.save(os.path.join(pack_dir, "boxes.npy"), boxes)
+    joblib.dump(filenames, os.path.join(pack_dir, "filenames.joblib"))
+    os.replace(temp_path, os.path.join(pack_dir, "images.npy"))
+
+
+class PaletteImage:
+    """
+    A pixel art image stored as an (H, W) uint8 map of indices into a
+    (K, C) uint8 palette, about a third of the size of the RGB image.
+    np.asarray(image) expands it back to the (H, W, C) image;
+    BatchImageTransform.collate expands whole batches at once.
+    """
+
+    def __init__(self, indices, palette):
+        self.indices = indices
+        self.palette = palette
+
+    @property
+    def shape(self):
+        return self.indices.shape + self.palette.shape[1:]
+
+    @property
+    def num_colors(self):
+        return len(self.palette)
+
+    def __array__(self, dtype=None, copy=None):
+        image = self.palette[self.indices]
+        return image if dtype is None else image.astype(dtype)
+
+
+def palettize_image(image, max_colors=256):
+    """
+    Splits an (H, W, C) uint8 image into a (K, C) palette of its distinct
+    colours and an (H, W) uint8 map of palette indices.
+    Returns num_colors, palette, indices (palette & indices are None if the
+    image has more than max_colors colours, e.g. noise backgrounds).
+    """
+    height, width, channels = image.shape
+    pixels = np.ascontiguousarray(image).reshape(-1, channels)
+    pixels = pixels.view(np.dtype((np.void, channels))).ravel()
+    palette, indices = np.unique(pixels, return_inverse=True)
+    if len(palette) > min(max_colors, 256):
+        return len(palette), None, None
+    palette = palette.view(np.uint8).reshape(-1, channels)
+    return len(palette), palette, indices.reshape(height, width).astype(np.uint8)
+
+
+def to_palette_image(image, max_colors=256):
+    # PaletteImage if the image has few enough colours, else a copy of the image
+    if image.ndim != 3:
+        return np.array(image)
+    _, palette, indices = palettize_image(image, max_colors)
+    if palette is None:
+        return np.array(image)
+    return PaletteImage(indices, palette)
+
+
+def expand_palette_images(images):
+    """
+    Expands a list of PaletteImages (same size, any number of colours)
+    into a (B, H, W, C) uint8 tensor with a single gather.
+    """
+    palettes = [torch.as_tensor(x.palette) for x in images]
+    offsets = torch.tensor([0] + [len(x) for x in palettes[:-1]]).cumsum(0)
+    indices = torch.stack([torch.as_tensor(x.indices) for x in images]).long()
+    return torch.cat(palettes)[indices + offsets[:, None, None]]
+
+
+def palettize_pack(pack_dir, max_colors=256):
+    """
+    Converts the images.npy of a pack_image_folder pack into palette storage:
+    - indices.npy: (N_palette, H, W) uint8 index maps
+    - palettes.joblib: all the palettes concatenated & where each one starts,
+      plus every image's colour count & where it is stored
+    - rgb_images.npy: (N_rgb, H, W, C) images with more than max_colors colours
+    indices.npy is moved into place last (images.npy is deleted after),
+    so its presence marks a complete pack.
+    Resizing while packing blends colours, so this works best on
+    packs at the original resolution.
+    """
+    images_path = os.path.join(pack_dir, "images.npy")
+    images = np.load(images_path, mmap_mode="r")
+    channels = images.shape[-1]
+    num_colors = np.empty(len(images), dtype=np.int32)
+    # Index based loops, so no view of the memmap outlives it (on Windows
+    # images.npy can't be removed while it is still mapped)
+    for i in tqdm(range(len(images)), desc=f"Counting colours {pack_dir}"):
+        num_colors[i] = palettize_image(images[i], max_colors)[0]
+
+    # Where every image is stored, -1 if it's in the other array
+    is_palette = num_colors <= min(max_colors, 256)
+    palette_ids = np.where(is_palette, np.cumsum(is_palette) - 1, -1).astype(np.int32)
+    rgb_ids = np.where(~is_palette, np.cumsum(~is_palette) - 1, -1).astype(np.int32)
+
+    rgb_images = np.lib.format.open_memmap(
+        os.path.join(pack_dir, "rgb_images.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(int((~is_palette).sum()),) + images.shape[1:],
+    )
+    for rgb_id, i in enumerate(np.flatnonzero(~is_palette)):
+        rgb_images[rgb_id] = images[i]
+    rgb_images.flush()
+    del rgb_images
+
+    temp_path = os.path.join(pack_dir, "indices.tmp.npy")
+    indices = np.lib.format.open_memmap(
+        temp_path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(int(is_palette.sum()),) + images.shape[1:3],
+    )
+    palettes = []
+    for palette_id, i in enumerate(
+        tqdm(np.flatnonzero(is_palette), desc=f"Palettizing {pack_dir}")
+    ):
+        _, palette, image_indices = palettize_image(images[i], max_colors)
+        indices[palette_id] = image_indices
+        palettes.append(palette)
+    indices.flush()
+    del indices, images
+
+    offsets = np.cumsum([0] + [len(x) for x in palettes])
+    palettes = np.concatenate(palettes) if len(palettes) > 0 else np.empty((0, channels), dtype=np.uint8)
+    joblib.dump(
+        {
+            "palettes": palettes,
+            "offsets": offsets,
+            "num_colors": num_colors,
+            "palette_ids": palette_ids,
+            "rgb_ids": rgb_ids,
+        },
+        os.path.join(pack_dir, "palettes.joblib"),
+    )
+    os.replace(temp_path, os.path.join(pack_dir, "indices.npy"))
+    os.remove(images_path)
+
+
+class PackedImageDataset(torch.utils.data.Dataset):
+    """
+    Serves a folder packed by pack_image_folder.
+    The images are memory mapped, so nothing is decoded and DataLoader
+    workers share the data through the page cache.
+    Without a transform, images are zero-copy (H, W, 3) uint8 tensors, or
+    PaletteImages for packs converted by palettize_pack (expanded by
+    BatchImageTransform.collate).
+    With a label file it works like CustomDatasetNoMemoryWithLabels.
+    Returns filename, image (, label).
+    """
+
+    def __init__(
+        self,
+        pack_dir,
+        transform=None,
+        use_noise_images=True,
+        label_file=None,
+        label_column=None,
+    ):
+        self.pack_dir = pack_dir
+        self.use_palette = os.path.exists(os.path.join(pack_dir, "indices.npy"))
+        self.palette = None
+        if self.use_palette:
+            self.palette = joblib.load(os.path.join(pack_dir, "palettes.joblib"))
+        filenames = joblib.load(os.path.join(pack_dir, "filenames.joblib"))
+        # Positions of the images we serve in the packed array
+        self.indices = np.array(
+            [i for i, x in enumerate(filenames) if use_noise_images or "noise" not in x]
+        )
+        self.filenames = [filenames[i] for i in self.indices]
+        self.labels = None
+        if label_file is not None:
+            labels = joblib.load(label_file)
+            labels = pd.DataFrame(labels).T[label_column].fillna("None")
+            self.classes = labels.unique()
+            self.labels = labels.to_dict()
+        self.transform = transform
+        self.arrays = {}
+
+    def get_array(self, name):
+        # Opened lazily so every worker process maps the file itself
+        if name not in self.arrays:
+            path = os.path.join(self.pack_dir, f"{name}.npy")
+            self.arrays[name] = np.load(path, mmap_mode="c")
+        return self.arrays[name]
+
+    def get_images_array(self):
+        return self.get_array("images")
+
+    def __getstate__(self):
+        # Don't pickle the mappings (it would copy the whole arrays)
+        state = self.__dict__.copy()
+        state["arrays"] = {}
+        return state
+
+    def get_image(self, position):
+        # Image at a position of the pack, (H, W, 3) uint8 or a PaletteImage
+        if not self.use_palette:
+            return self.get_images_array()[position]
+        palette_id = self.palette["palette_ids"][position]
+        if palette_id < 0:
+            return self.get_array("rgb_images")[self.palette["rgb_ids"][position]]
+        start, end = self.palette["offsets"][palette_id : palette_id + 2]
+        return PaletteImage(
+            self.get_array("indices")[palette_id], self.palette["palettes"][start:end]
+        )
+
+    def get_boxes(self, size=None, padding=0):
+        """
+        Foreground boxes (top, left, bottom, right) of the images, rescaled
+        to a size x size grid if given (see scale_boxes).
+        Packs made before boxes.npy existed get them computed here.
+        """
+        boxes_path = os.path.join(self.pack_dir, "boxes.npy")
+        if os.path.exists(boxes_path):
+            boxes = np.load(boxes_path)[self.indices]
+        else:
+            boxes = np.array(
+                [get_foreground_box(np.asarray(self.get_image(i))) for i in self.indices]
+            ).reshape(-1, 4)
+        if size is not None:
+            image_shape = self.get_image(self.indices[0]).shape[:2]
+            boxes = scale_boxes(boxes, image_shape, size, padding)
+        return boxes
+
+    def get_num_colors(self):
+        # Number of distinct colours of every image, without decoding anything
+        if not self.use_palette:
+            raise ValueError(f"{self.pack_dir} isn't palettized, see palettize_pack")
+        return self.palette["num_colors"][self.indices]
+
+    def __getitem__(self, index):
+        filename = self.filenames[index]
+        image = self.get_image(self.indices[index])
+        if self.transform is not None:
+            image = self.transform(np.asarray(image))
+        elif not isinstance(image, PaletteImage):
+            image = torch.from_numpy(image)
+        if self.labels is not None:
+            return filename, image, self.labels[filename]
+        return filename, image
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def get_classes(self):
+        return self.classes
+
+
+def load_packed_dataset(
+    folder,
+    pack_dir,
+    transform=None,
+    use_noise_images=True,
+    image_size=None,
+    palettize=False,
+):
+    """
+    Returns a PackedImageDataset for folder, packing it into pack_dir first
+    if that hasn't been done yet (resized to image_size if given).
+    With palettize, the pack is converted to palette storage (palettize_pack).
+    Delete pack_dir to repack after the folder changes.
+    """
+    is_palettized = os.path.exists(os.path.join(pack_dir, "indices.npy"))
+    if not is_palettized and not os.path.exists(os.path.join(pack_dir, "images.npy")):
+        pack_image_folder(folder, pack_dir, image_size)
+    if palettize and not is_palettized:
+        palettize_pack(pack_dir)
+    return PackedImageDataset(pack_dir, transform, use_noise_images)
+
+
+class TokenDataset(torch.utils.data.Dataset):
+    """
+    Serves VQ-VAE encodings cached by create_token_cache.
+    The (N, H, W) codes are memory mapped, so nothing is decoded and
+    DataLoader workers share the data through the page cache.
+    Returns filename, (H, W) grid of codebook indices.
+    """
+
+    def __init__(self, cache_dir):
+        self.codes_path = os.path.join(cache_dir, "codes.npy")
+        self.filenames = joblib.load(os.path.join(cache_dir, "filenames.joblib"))
+        self.filename_to_index = {x: i for i, x in enumerate(self.filenames)}
+        self.codes = None
+
+    def get_codes_array(self):
+        # Opened lazily so every worker process maps the file itself
+        if self.codes is None:
+            self.codes = np.load(self.codes_path, mmap_mode="c")
+        return self.codes
+
+    def __getstate__(self):
+        # Don't pickle the mapping (it would copy the whole array)
+        state = self.__dict__.copy()
+        state["codes"] = None
+        return state
+
+    def __getitem__(self, index):
+        codes = torch.from_numpy(self.get_codes_array()[index])
+        return self.filenames[index], codes
+
+    def get_codes(self, filenames):
+        # Look up a batch of code grids by filename
+        indices = [self.filename_to_index[x] for x in filenames]
+        return torch.from_numpy(self.get_codes_array()[indices])
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+def get_vqvae_cache_key(vq_vae, vq_vae_config):
+    """
+    Hash of a VQ-VAE's weights and config.
+    Cached encodings are keyed by this so they get rebuilt when either changes.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps(vq_vae_config, sort_keys=True, default=str).encode())
+    for name, tensor in sorted(vq_vae.state_dict().items()):
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def create_token_cache(vq_vae, dataset, cache_dir, device, batch_size=256):
+    """
+    Encodes every image of a (filename, image) dataset once with a frozen VQ-VAE.
+    Writes the codes as a memory mapped (N, H, W) array plus the filenames.
+    codes.npy is moved into place last, so its presence marks a complete cache.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False
+    )
+    temp_path = os.path.join(cache_dir, "codes.tmp.npy")
+    codes = None
+    filenames = []
+    with torch.no_grad():
+        for batch_filenames, batch in tqdm(dataloader, desc="Caching encodings"):
+            batch_codes = vq_vae.encode(batch.to(device)).cpu().numpy()
+            if codes is None:
+                codes = np.lib.format.open_memmap(
+                    temp_path,
+                    mode="w+",
+                    dtype=batch_codes.dtype,
+                    shape=(len(dataset),) + batch_codes.shape[1:],
+                )
+            codes[len(filenames) : len(filenames) + len(batch_codes)] = batch_codes
+            filenames.extend(batch_filenames)
+    codes.flush()
+    del codes
+    joblib.dump(filenames, os.path.join(cache_dir, "filenames.joblib"))
+    os.replace(temp_path, os.path.join(cache_dir, "codes.npy"))
+
+
+def get_dataset_filenames(dataset):
+    # Filenames of a (filename, image) dataset, in order
+    for attribute in ["filenames", "keys", "all_images"]:
+        if isinstance(getattr(dataset, attribute, None), list):
+            return getattr(dataset, attribute)
+    return [dataset[i][0] for i in range(len(dataset))]
+
+
+def get_dataset_cache_key(dataset, filenames):
+    """
+    Hash of a dataset's folder and (ordered) filenames.
+    Token caches are keyed by this so every dataset gets its own cache.
+    """
+    hasher = hashlib.sha1()
+    for attribute in ["pack_dir", "dataset_path", "fusion_dataset_path"]:
+        folder = getattr(dataset, attribute, None)
+        if folder is not None:
+            hasher.update(os.path.abspath(folder).encode())
+    hasher.update(json.dumps(filenames).encode())
+    return hasher.hexdigest()[:16]
+
+
+def is_token_cache_dir(path):
+    # cache_root/<key> directories hold one create_token_cache output per split
+    if not os.path.isdir(path):
+        return False
+    splits = os.listdir(path)
+    return len(splits) > 0 and all(
+        os.path.exists(os.path.join(path, split, "codes.npy"))
+        or os.path.exists(os.path.join(path, split, "codes.tmp.npy"))
+        for split in splits
+    )
+
+
+def load_token_cache(
+    vq_vae, vq_vae_config, dataset, cache_root, split, device, batch_size=256
+):
+    """
+    Returns a TokenDataset with the VQ-VAE encodings of a dataset split.
+    Caches live in cache_root/<weights & config hash>/<split>_<dataset hash>,
+    the dataset hash covers its folder and filenames (in order).
+    The cache is (re)built if missing or if its filenames don't match.
+    Token caches for other weights/configs under cache_root are deleted
+    (only directories made by create_token_cache, anything else is left alone).
+    """
+    key = get_vqvae_cache_key(vq_vae, vq_vae_config)
+    if os.path.exists(cache_root):
+        for stale in os.listdir(cache_root):
+            stale_dir = os.path.join(cache_root, stale)
+            if stale != key and is_token_cache_dir(stale_dir):
+                print(f"Deleting the token cache of other VQ-VAE weights: {stale_dir}")
+                shutil.rmtree(stale_dir)
+    filenames = list(get_dataset_filenames(dataset))
+    dataset_key = get_dataset_cache_key(dataset, filenames)
+    cache_dir = os.path.join(cache_root, key, f"{split}_{dataset_key}")
+    if os.path.exists(os.path.join(cache_dir, "codes.npy")):
+        tokens = TokenDataset(cache_dir)
+        if list(tokens.filenames) == filenames:
+            return tokens
+    create_token_cache(vq_vae, dataset, cache_dir, device, batch_size)
+    return TokenDataset(cache_dir)
+
+
+class ShardedCodeWriter:
+    """
+    Streams VQ-VAE codes to disk in fixed size shards as batches finish.
+    Only integer codes are stored, embeddings can be rebuilt from the codebook.
+    On close, writes a manifest (filename, shard, offset & metadata columns)
+    and an info.json describing the shards.
+    Memory use is a single shard regardless of the dataset size.
+    Shards, manifest & info.json of a previous run in output_dir are deleted.
+    """
+
+    def __init__(self, output_dir, shard_size=4096, metadata_columns=None):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # A previous (e.g. larger) run would leave extra shards behind
+        for file in os.listdir(output_dir):
+            if file.startswith("shard_") or file in ["manifest.csv", "info.json"]:
+                os.remove(os.path.join(output_dir, file))
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.metadata_columns = metadata_columns or []
+        self.buffer = None
+        self.buffer_count = 0
+        self.num_shards = 0
+        self.rows = []
+
+    def add(self, codes, filenames, metadata=None):
+        """
+        codes - (B, H, W) integer array/tensor
+        filenames - B filenames
+        metadata (optional) - B rows of values for metadata_columns
+        """
+        codes = np.asarray(codes.cpu() if torch.is_tensor(codes) else codes)
+        if self.buffer is None:
+            self.buffer = np.empty((self.shard_size,) + codes.shape[1:], codes.dtype)
+        metadata = metadata if metadata is not None else [[]] * len(codes)
+        for code, filename, row in zip(codes, filenames, metadata):
+            if not isinstance(row, (list, tuple)):
+                row = [row]
+            self.buffer[self.buffer_count] = code
+            self.rows.append(
+                [filename, self.num_shards, self.buffer_count] + list(row)
+            )
+            self.buffer_count += 1
+            if self.buffer_count == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        if self.buffer_count == 0:
+            return
+        shard_path = os.path.join(self.output_dir, f"shard_{self.num_shards:05d}.npy")
+        np.save(shard_path, self.buffer[: self.buffer_count])
+        self.num_shards += 1
+        self.buffer_count = 0
+
+    def close(self, **info):
+        """Writes the last shard and the manifest. info is stored in info.json"""
+        self.flush()
+        columns = ["filename", "shard", "offset"] + list(self.metadata_columns)
+        manifest = pd.DataFrame(self.rows, columns=columns)
+        manifest.to_csv(os.path.join(self.output_dir, "manifest.csv"), index=False)
+        info.update(
+            {
+                "num_items": len(self.rows),
+                "num_shards": self.num_shards,
+                "shard_size": self.shard_size,
+                "code_shape": list(self.buffer.shape[1:]) if self.rows else [],
+                "dtype": str(self.buffer.dtype) if self.rows else None,
+            }
+        )
+        with open(os.path.join(self.output_dir, "info.json"), "w") as f:
+            json.dump(info, f, indent=4)
+
+
+class ShardedCodeDataset(torch.utils.data.Dataset):
+    """
+    Reads the shards written by ShardedCodeWriter.
+    Shards are memory mapped lazily the first time they are accessed.
+    If a codebook tensor (num_embeddings, embedding_dim) is given,
+    items are the (embedding_dim, H, W) embeddings rebuilt from the codes.
+    Returns filename, codes (or embeddings).
+    """
+
+    def __init__(self, shard_dir, codebook=None):
+        self.shard_dir = shard_dir
+        self.manifest = pd.read_csv(os.path.join(shard_dir, "manifest.csv"))
+        self.filenames = self.manifest["filename"].tolist()
+        self.shards = self.manifest["shard"].to_numpy()
+        self.offsets = self.manifest["offset"].to_numpy()
+        self.codebook = codebook
+        self.mapped_shards = {}
+
+    def get_shard(self, shard):
+        if shard not in self.mapped_shards:
+            shard_path = os.path.join(self.shard_dir, f"shard_{shard:05d}.npy")
+            self.mapped_shards[shard] = np.load(shard_path, mmap_mode="c")
+        return self.mapped_shards[shard]
+
+    def __getstate__(self):
+        # Each worker maps the shards itself
+        state = self.__dict__.copy()
+        state["mapped_shards"] = {}
+        return state
+
+    def __getitem__(self, index):
+        shard = self.get_shard(int(self.shards[index]))
+        codes = torch.from_numpy(shard[self.offsets[index]])
+        if self.codebook is not None:
+            return self.filenames[index], self.codebook[codes.long()].permute(2, 0, 1)
+        return self.filenames[index], codes
+
+    def get_metadata(self):
+        """Returns the metadata columns of the manifest"""
+        return self.manifest.drop(columns=["filename", "shard", "offset"])
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+def load_image_array(paths, num_workers=None):
+    """
+    Decodes the images into one preallocated (N, H, W[, C]) array.
+    Image i of the array is paths[i], whatever order the workers finish in.
+    Decoding runs on a thread pool (PIL releases the GIL while decoding) &
+    every worker writes straight into its slot of the array.
+    All the images need the same size & mode, otherwise raises a ValueError.
+    """
+    if len(paths) == 0:
+        raise ValueError("No images to load")
+    with Image.open(paths[0]) as image:
+        size, mode = image.size, image.mode
+        first_image = np.asarray(image)
+    # Only reads the headers
+    for path in paths[1:]:
+        with Image.open(path) as image:
+            if image.size != size or image.mode != mode:
+                raise ValueError(
+                    f"{path} is {image.mode} {image.size}, expected {mode} {size}"
+                )
+
+    images = np.empty((len(paths),) + first_image.shape, dtype=first_image.dtype)
+    images[0] = first_image
+
+    def load(index):
+        with Image.open(paths[index]) as image:
+            images[index] = np.asarray(image)
+
+    num_workers = num_workers or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(load, i) for i in range(1, len(paths))]
+        for future in tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(paths),
+            initial=1,
+            desc="Loading images",
+        ):
+            future.result()
+    return images
+
+
+def load_images_from_folder(folder, use_noise_images, num_workers=None, palettize=False):
+    """
+    Returns a dict of form filename:image.
+    The images are views into one contiguous array when they all have the
+    same size & mode (see load_image_array).
+    With palettize, images with at most 256 colours are stored as PaletteImages.
+    """
+    files = [
+        file
+        for file in sorted(os.listdir(folder))
+        if use_noise_images or "noise" not in file
+    ]
+    paths = [os.path.join(folder, file) for file in files]
+    try:
+        images = load_image_array(paths, num_workers)
+    except ValueError:
+        # Mixed sizes or modes, decode them one at a time
+        images = [np.array(Image.open(path)) for path in tqdm(paths)]
+    if palettize:
+        images = [to_palette_image(x) for x in tqdm(images, desc="Palettizing")]
+    dataset = dict(zip(files, images))
     print(f"Loaded {len(dataset)} images.")
     return dataset
 
@@ -655,27 +1823,186 @@ def get_samples_from_data(data, sample_size, fusion=False):
 
 
 def get_samples_from_FusionDatasetV2(data, sample_size, mode):
+    """
+    Draws sample_size different items of a mode ("standard" or "fusion",
+    see FusionDatasetV2.get_indices) & only loads those.
+    """
+    indices = data.get_indices(mode)
+    if len(indices) < sample_size:
+        raise ValueError(
+            f"Error obtaining samples. Sample Size={sample_size}, {mode} items={len(indices)}"
+        )
     samples = []
-    previous_i = []
-    iterations = 0
-    while len(samples) < sample_size and iterations <= 10000:
-        i = np.random.choice(len(data))
-        while i in previous_i:
-            i = np.random.choice(len(data))
+    for i in np.random.choice(indices, size=sample_size, replace=False):
         _, (base, fusee, fusion) = data[i]
-        tensors_are_same = torch.equal(base, fusee)
-        if mode == "standard" and tensors_are_same:
+        if mode == "standard":
             samples.append(np.asarray(base))
-        elif mode == "fusion" and not tensors_are_same:
-            sample = [np.asarray(x) for x in [base, fusee, fusion]]
-            samples.append(sample)
-        previous_i.append(i)
-        iterations += 1
-    if len(samples) != sample_size:
-        raise ValueError(
-            f"Error obtaining samples. Iterations={iterations}, Sample Size={sample_size}, Samples Obtained={len(samples)}"
+        else:
+            samples.append([np.asarray(x) for x in [base, fusee, fusion]])
+    return torch.as_tensor(np.array(samples))
+
+
+def get_resized_shape(height, width, image_size):
+    # Same rule as transforms.Resize(image_size): the smaller edge becomes image_size
+    if height <= width:
+        return image_size, int(image_size * width / height)
+    return int(image_size * height / width), image_size
+
+
+class BatchImageTransform:
+    """
+    Batch level version of image2tensor_resize for datasets that return
+    uint8 (H, W, 3) images or PaletteImages, e.g. PackedImageDataset
+    without a transform.
+    Use collate as the DataLoader collate_fn: images are stacked and
+    converted to float once per batch, and only resized (one bicubic resize
+    for the whole batch) if they don't already have the target size.
+    Calling it directly converts an already stacked (B, H, W, 3) uint8 batch.
+    """
+
+    def __init__(self, image_size):
+        self.image_size = image_size
+        self.resize = transforms.Resize(
+            image_size, interpolation=transforms.InterpolationMode.BICUBIC
+        )
+
+    def __call__(self, images):
+        images = images.permute(0, 3, 1, 2).float().div_(255)
+        height, width = images.shape[-2:]
+        if (height, width) != get_resized_shape(height, width, self.image_size):
+            images = self.resize(images)
+        return images
+
+    def collate(self, batch):
+        # Items are (filename, image, *other) like the other datasets return
+        filenames, images, *others = zip(*batch)
+        images = list(images)
+        palettized = [i for i, x in enumerate(images) if isinstance(x, PaletteImage)]
+        if len(palettized) > 0:
+            expanded = expand_palette_images([images[i] for i in palettized])
+            for i, image in zip(palettized, expanded):
+                images[i] = image
+        images = [torch.as_tensor(x) for x in images]
+        if all(x.shape == images[0].shape for x in images):
+            images = self(torch.stack(images))
+        else:
+            images = torch.cat([self(x.unsqueeze(0)) for x in images])
+        others = [torch.utils.data.dataloader.default_collate(x) for x in others]
+        return (list(filenames), images, *others)
+
+
+def map_tensors(batch, function):
+    # Applies function to every tensor of a nested tuple/list/dict batch
+    if isinstance(batch, torch.Tensor):
+        return function(batch)
+    if isinstance(batch, dict):
+        return {key: map_tensors(value, function) for key, value in batch.items()}
+    if isinstance(batch, list):
+        return [map_tensors(x, function) for x in batch]
+    if isinstance(batch, tuple):
+        return tuple(map_tensors(x, function) for x in batch)
+    return batch
+
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader so a background thread loads the next num_prefetch
+    batches & starts their copies to the device while the model trains.
+    On a GPU, batches are pinned & copied without blocking on a separate
+    CUDA stream. On the CPU, loading still overlaps with compute.
+    Batches can be any nesting of tuples, lists & dicts (e.g. FusionDatasetV2
+    or CustomImage2ImageDatasetWithLabels batches), other values such as
+    filenames are passed through as is.
+    get_stats() reports how long the last pass waited for batches.
+    The loader iterator & first batch are made on the calling thread, so the
+    sampler's shuffle (& the workers' seeds) come from the global RNG at the
+    same point as without the prefetcher. With num_workers=0, random
+    transforms of later batches still run on the background thread.
+    """
+
+    def __init__(self, loader, device, num_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.use_cuda = self.device.type == "cuda"
+        self.wait_times = []
+
+    def move(self, tensor):
+        if self.use_cuda and not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=self.use_cuda)
+
+    def put(self, batches, stop, item):
+        # Gives up once the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load(self, loader_batches, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            for batch in loader_batches:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = map_tensors(batch, self.move)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = map_tensors(batch, self.move)
+                if not self.put(batches, stop, (batch, event, None)):
+                    return
+        except Exception as error:
+            self.put(batches, stop, (None, None, error))
+            return
+        self.put(batches, stop, None)
+
+    def __iter__(self):
+        self.wait_times = []
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        # The sampler draws its order lazily, on the first batch
+        iterator = iter(self.loader)
+        first = list(itertools.islice(iterator, 1))
+        loader_batches = itertools.chain(first, iterator)
+        thread = threading.Thread(
+            target=self.load, args=(loader_batches, batches, stop), daemon=True
         )
-    return torch.as_tensor(samples)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                if item is None:
+                    break
+                self.wait_times.append(time.perf_counter() - start)
+                batch, event, error = item
+                if error is not None:
+                    raise error
+                if event is not None:
+                    # Wait for the copy & keep the memory until the model is done
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    map_tensors(batch, lambda x: x.record_stream(stream))
+                yield batch
+        finally:
+            stop.set()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def get_stats(self):
+        wait_times = np.array(self.wait_times)
+        return {
+            "steps": len(wait_times),
+            "total_wait": float(wait_times.sum()),
+            "mean_wait": float(wait_times.mean()) if len(wait_times) > 0 else 0.0,
+            "max_wait": float(wait_times.max()) if len(wait_times) > 0 else 0.0,
+        }
 
 
 def image2tensor_resize(image_size):
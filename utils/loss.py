@@ -9,6 +9,16 @@ def bits_per_dimension_loss(x_pred, x):
     return bpd.mean()
 
 
+def masked_crossentropy_loss(x_pred, x, mask):
+    """
+    Cross entropy averaged over the positions where mask is True,
+    e.g. to leave out known background tokens.
+    """
+    nll = nn.functional.cross_entropy(x_pred, x, reduction="none")
+    mask = mask.expand_as(nll)
+    return nll[mask].sum() / mask.sum().clamp(min=1)
+
+
 def rmse_loss(reconstructed_x, x, use_sum=False, epsilon=1e-8):
     """
     We use epsilon to avoid NaN during backprop if mse = 0.
@@ -30,6 +30,8 @@ learning_rate = 1e-4
 epochs = 25
 batch_size = 64
 num_dataloader_workers = 0
+use_prefetcher = False  # Load & copy the next batches to the device in the background
+num_prefetch_batches = 2
 
 # VQ-VAE Config
 num_layers = 0
@@ -50,8 +52,25 @@ ssim_weight = 1
 image_size = 64
 use_noise_images = True
 load_data_to_memory = True
+# Read the images from a packed memory mapped file (written on first use),
+# takes precedence over load_data_to_memory
+use_packed_data = False
+pack_at_image_size = False  # Resize once while packing (bicubic, blends colours)
+use_batch_transform = False  # Convert & resize whole batches (packed or in memory data)
+# Store the images as palette indices (packed or in memory data, ~3x smaller)
+# Best with pack_at_image_size = False since resizing blends the colours
+use_palette_images = False
+# Augment the original RGBA sprites on the fly instead of reading preprocess.py's output
+use_sprite_augmentation = False
+original_data_folder = "data\\Pokemon\\original_data"
+num_test_ids = 100  # Pokedex IDs held out for testing (like preprocess.py)
+num_val_ids = 100  # Pokedex IDs held out for validation (like preprocess.py)
 
 data_prefix = "data\\Pokemon\\final\\standard"
+if pack_at_image_size:
+    packed_data_prefix = f"{data_prefix}_packed_{image_size}"
+else:
+    packed_data_prefix = f"{data_prefix}_packed"
 train_data_folder = os.path.join(data_prefix, "train")
 val_data_folder = os.path.join(data_prefix, "val")
 test_data_folder = os.path.join(data_prefix, "test")
@@ -86,12 +105,73 @@ if not os.path.exists(output_dir):
 
 # Preprocess & Create Data Loaders
 transform = data.image2tensor_resize(image_size)
-
-if load_data_to_memory:
+pack_image_size = image_size if pack_at_image_size else None
+
+batch_transform = None
+collate_fn = None
+use_uint8_data = use_packed_data or load_data_to_memory
+if use_uint8_data and use_batch_transform and not use_sprite_augmentation:
+    # The datasets return uint8 images, the dataloaders convert whole batches
+    batch_transform = data.BatchImageTransform(image_size)
+    collate_fn = batch_transform.collate
+    transform = None
+
+if use_sprite_augmentation:
+    # Same split, backgrounds, rotations & flips as preprocess.py
+    # Noise backgrounds only for the training data
+    split_ids = data.split_sprite_ids(
+        original_data_folder, num_test_ids, num_val_ids, seed
+    )
+    train_data = data.AugmentedSpriteDataset(
+        original_data_folder,
+        split_ids["train"],
+        use_noise=use_noise_images,
+        image_size=image_size,
+        seed=seed,
+    )
+    val_data = data.AugmentedSpriteDataset(
+        original_data_folder, split_ids["val"], image_size=image_size, seed=seed
+    )
+    test_data = data.AugmentedSpriteDataset(
+        original_data_folder, split_ids["test"], image_size=image_size, seed=seed
+    )
+elif use_packed_data:
+    # Packs each split into one memory mapped file the first time
+    train_data = data.load_packed_dataset(
+        train_data_folder,
+        os.path.join(packed_data_prefix, "train"),
+        transform,
+        use_noise_images,
+        pack_image_size,
+        use_palette_images,
+    )
+    val_data = data.load_packed_dataset(
+        val_data_folder,
+        os.path.join(packed_data_prefix, "val"),
+        transform,
+        use_noise_images,
+        pack_image_size,
+        use_palette_images,
+    )
+    test_data = data.load_packed_dataset(
+        test_data_folder,
+        os.path.join(packed_data_prefix, "test"),
+        transform,
+        use_noise_images,
+        pack_image_size,
+        use_palette_images,
+    )
+elif load_data_to_memory:
     # Load Data
-    train = data.load_images_from_folder(train_data_folder, use_noise_images)
-    val = data.load_images_from_folder(val_data_folder, use_noise_images)
-    test = data.load_images_from_folder(test_data_folder, use_noise_images)
+    train = data.load_images_from_folder(
+        train_data_folder, use_noise_images, palettize=use_palette_images
+    )
+    val = data.load_images_from_folder(
+        val_data_folder, use_noise_images, palettize=use_palette_images
+    )
+    test = data.load_images_from_folder(
+        test_data_folder, use_noise_images, palettize=use_palette_images
+    )
 
     train_data = data.CustomDataset(train, transform)
     val_data = data.CustomDataset(val, transform)
@@ -108,6 +188,7 @@ train_dataloader = torch.utils.data.DataLoader(
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
+    collate_fn=collate_fn,
 )
 val_dataloader = torch.utils.data.DataLoader(
     val_data,
@@ -115,6 +196,7 @@ val_dataloader = torch.utils.data.DataLoader(
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
+    collate_fn=collate_fn,
 )
 test_dataloader = torch.utils.data.DataLoader(
     test_data,
@@ -122,10 +204,18 @@ test_dataloader = torch.utils.data.DataLoader(
     shuffle=True,
     num_workers=num_dataloader_workers,
     pin_memory=gpu,
+    collate_fn=collate_fn,
 )
 
+if use_prefetcher:
+    train_dataloader = data.DevicePrefetcher(train_dataloader, device, num_prefetch_batches)
+    val_dataloader = data.DevicePrefetcher(val_dataloader, device, num_prefetch_batches)
+    test_dataloader = data.DevicePrefetcher(test_dataloader, device, num_prefetch_batches)
+
 # Creating a sample set to visualize the model's training
 sample = data.get_samples_from_data(val_data, 16)
+if batch_transform is not None:
+    sample = batch_transform(sample)
 
 ################################################################################
 ##################################### Model ####################################
@@ -285,6 +375,9 @@ for epoch in range(epochs):
         \nVal Commitment Loss = {val_vq_loss}\
         \nVal Perplexity = {val_epoch_perplexity}"
     )
+    if use_prefetcher:
+        # Time spent waiting for batches, high values mean the input pipeline is the bottleneck
+        print(f"Train data wait: {train_dataloader.get_stats()}")
 
 ################################################################################
 ################################## Save & Test #################################
@@ -353,6 +446,8 @@ print(f"\nMSE = {mse}, SSIM = {ssim_score}")
 
 # Pick a couple of sample images for an Input v Output comparison
 test_sample = data.get_samples_from_data(test_data, 16)
+if batch_transform is not None:
+    test_sample = batch_transform(test_sample)
 
 # Plot A Set of Test Images
 fig, axis = graphics.make_grid(("Test Sample", test_sample), 4, 4)